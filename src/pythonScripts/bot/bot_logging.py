@@ -0,0 +1,121 @@
+import atexit
+import gzip
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import shutil
+import time
+
+MAX_BYTES = 20_000_000
+MAX_AGE = 86400  # seconds before a log file is rotated even if it is small
+BACKUP_COUNT = 10
+
+_listeners = []
+
+
+class RotatingCompressedFileHandler(logging.handlers.RotatingFileHandler):
+    """rotates by size or age, whichever comes first, and gzips the rotated files"""
+
+    def __init__(self, filename, max_bytes=MAX_BYTES, max_age=MAX_AGE, backup_count=BACKUP_COUNT, compress=True):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+        self.max_age = max_age
+        self.opened = time.time()
+        if compress:
+            self.namer = lambda name: name + ".gz"
+            self.rotator = self._gzip_rotate
+
+    def shouldRollover(self, record):
+        if self.max_age and time.time() - self.opened >= self.max_age:
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        self.opened = time.time()
+
+    @staticmethod
+    def _gzip_rotate(source, dest):
+        with open(source, "rb") as f_in, gzip.open(dest, "wb") as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        os.remove(source)
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """one compact JSON object per record: time, level, message and any non-None `extra` fields in FIELDS"""
+
+    FIELDS = ("lobby", "direction", "socket", "event", "data")
+
+    def format(self, record):
+        line = {"t": round(record.created, 3), "level": record.levelname, "msg": record.getMessage()}
+        for field in self.FIELDS:
+            if getattr(record, field, None) is not None:
+                line[field] = getattr(record, field)
+        return json.dumps(line, separators=(",", ":"), default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """plain log lines, with a [lobby] tag on records from a LobbyAdapter"""
+
+    def __init__(self):
+        super().__init__("%(asctime)s - %(levelname)s - %(lobby_tag)s%(message)s", "%Y-%m-%d %H:%M:%S")
+
+    def format(self, record):
+        record.lobby_tag = f"[{record.lobby}] " if getattr(record, "lobby", None) else ""
+        return super().format(record)
+
+
+class LobbyAdapter(logging.LoggerAdapter):
+    """adds a lobby field to every record, keeping the call's own extra fields"""
+
+    def process(self, msg, kwargs):
+        kwargs["extra"] = {**kwargs.get("extra", {}), "lobby": self.extra["lobby"]}
+        return msg, kwargs
+
+
+class SampleFilter(logging.Filter):
+    """keep one in rates[event] records of each event type; types not in rates are all kept"""
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+        self.seen = {}
+
+    def filter(self, record):
+        rate = self.rates.get(getattr(record, "event", None), 1)
+        if rate <= 1:
+            return True
+        n = self.seen.get(record.event, 0)
+        self.seen[record.event] = n + 1
+        return n % rate == 0
+
+
+def setup_logger(name, filename, structured=False, sample_rates=None, compress=True):
+    """logger whose records are written to filename by a background thread"""
+    file_handler = RotatingCompressedFileHandler(filename, compress=compress)
+    if structured:
+        file_handler.setFormatter(JsonLinesFormatter())
+    else:
+        file_handler.setFormatter(TextFormatter())
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    if sample_rates:
+        queue_handler.addFilter(SampleFilter(sample_rates))
+    listener = logging.handlers.QueueListener(log_queue, file_handler)
+    listener.start()
+    _listeners.append(listener)
+
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    logger.addHandler(queue_handler)
+    return logger
+
+
+@atexit.register
+def _stop_listeners():
+    # drains whatever is still queued
+    for listener in _listeners:
+        listener.stop()
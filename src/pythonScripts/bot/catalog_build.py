@@ -0,0 +1,71 @@
+import argparse
+import json
+import os
+
+from maps import CATALOG_PATH, get_catalog_artifact, sheet_cache
+
+SITE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+
+
+def clean_map_name(name):
+    # Find the *last* ' by ' and remove everything after it
+    parts = name.rsplit(" by ", 1)
+    if len(parts) == 2 and len(parts[1]) <= 100:
+        return parts[0]
+    return name
+
+
+def presets_json(artifact):
+    """map name -> preset, for the website's presets.json"""
+    return {clean_map_name(m["name"]): m["preset"] for m in artifact["maps"]}
+
+
+def map_metadata_json(artifact):
+    """map name -> difficulty, balls and preset for the website's map_metadata.json, from every sheet row"""
+    map_metadata = {}
+    for m in artifact["rows"]:
+        # Clean the map name (remove " by Author" part)
+        map_name = m["name"].rsplit(" by ", 1)[0] if " by " in m["name"] else m["name"]
+        map_metadata[map_name] = {
+            "difficulty": m["difficulty"],
+            "balls_req": m["balls_req"],
+            "preset": m["preset"]
+        }
+    return map_metadata
+
+
+def write_json_if_changed(path, data):
+    """write data as indented JSON unless the file already holds exactly that; True if written"""
+    text = json.dumps(data, indent=4)
+    try:
+        with open(path) as f:
+            if f.read() == text:
+                return False
+    except OSError:
+        pass
+    with open(path + ".tmp", "w") as f:
+        f.write(text)
+    os.replace(path + ".tmp", path)
+    return True
+
+
+def build(presets_path, metadata_path, artifact_path=CATALOG_PATH):
+    """fetch the sheet once, compile the artifact and derive the website files from it"""
+    artifact = get_catalog_artifact(sheet_cache.get_fresh(), artifact_path)
+    print(f"catalog {artifact['hash'][:12]}: {len(artifact['maps'])} maps, {len(artifact['illegal'])} rejected")
+    for path, data in ((presets_path, presets_json(artifact)), (metadata_path, map_metadata_json(artifact))):
+        print(("Updated " if write_json_if_changed(path, data) else "Unchanged ") + path)
+    return artifact
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compile the map sheet into catalog.json and the website's JSON files")
+    parser.add_argument("--presets", default=os.path.join(SITE_DIR, "presets.json"), help="presets.json to write")
+    parser.add_argument("--metadata", default=os.path.join(SITE_DIR, "map_metadata.json"), help="map_metadata.json to write")
+    args = parser.parse_args()
+
+    build(os.path.normpath(args.presets), os.path.normpath(args.metadata))
+
+
+if __name__ == "__main__":
+    main()
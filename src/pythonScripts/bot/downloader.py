@@ -0,0 +1,127 @@
+import asyncio
+import random
+import time
+
+import requests
+
+import http_client
+from replay_files import write_replay
+
+REPLAY_DATA_URL = "https://tagpro.koalabeast.com/replays/data"
+GAME_FILE_URL = "https://tagpro.koalabeast.com/replays/gameFile"
+
+
+class RateLimited(Exception):
+    def __init__(self, retry_after=None):
+        super().__init__(f"rate limited (retry after {retry_after})")
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value):
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+class AdaptiveTokenBucket:
+    """token bucket for the replay server; a 429 halves the rate and pauses it"""
+
+    def __init__(self, rate=2.0, min_rate=0.1, max_rate=10.0, burst=4):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = None
+
+    async def acquire(self):
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def on_success(self):
+        self.rate = min(self.max_rate, self.rate + 0.05)
+
+    def on_rate_limited(self, retry_after=None):
+        self.rate = max(self.min_rate, self.rate / 2)
+        self.tokens = 0
+        self.paused_until = max(self.paused_until, time.monotonic() + (retry_after or 1 / self.rate))
+        self.updated = self.paused_until  # refill from the end of the pause, not across it
+
+
+class ReplayDownloader:
+    """concurrent replay downloads: data lookups and gameFile fetches run as separate stages"""
+
+    def __init__(self, replay_dir, lookup_concurrency=4, fetch_concurrency=4, max_attempts=5):
+        self.replay_dir = replay_dir
+        self.lookup_concurrency = lookup_concurrency
+        self.fetch_concurrency = fetch_concurrency
+        self.max_attempts = max_attempts
+        self.bucket = AdaptiveTokenBucket()
+
+    def download(self, uuids):
+        """download uuids into replay_dir: {uuid: True (saved), False (not one game), None (gave up)}"""
+        if not uuids:
+            return {}
+        return asyncio.run(self._download_all(uuids))
+
+    async def _download_all(self, uuids):
+        self.bucket.lock = None  # asyncio locks are tied to the loop that first uses them
+        lookup_slots = asyncio.Semaphore(self.lookup_concurrency)
+        fetch_slots = asyncio.Semaphore(self.fetch_concurrency)
+        results = await asyncio.gather(*(self._download_one(uuid, lookup_slots, fetch_slots) for uuid in uuids))
+        return dict(zip(uuids, results))
+
+    async def _download_one(self, uuid, lookup_slots, fetch_slots):
+        for attempt in range(self.max_attempts):
+            try:
+                async with lookup_slots:
+                    game_id = await self._lookup(uuid)
+                if game_id is None:
+                    return False
+                async with fetch_slots:
+                    lines = await self._fetch(game_id)
+                await asyncio.to_thread(write_replay, self.replay_dir, uuid, lines)
+                return True
+            except RateLimited as e:
+                delay = max(e.retry_after or 0, 2 ** attempt)
+            except (requests.RequestException, ValueError) as e:
+                print("download error for", uuid, e)
+                delay = 2 ** attempt
+            await asyncio.sleep(min(300, delay) * random.uniform(1, 1.5))
+        return None
+
+    async def _get(self, url, params):
+        await self.bucket.acquire()
+        response = await asyncio.to_thread(http_client.get, url, params=params)
+        if response.status_code == 429:
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            self.bucket.on_rate_limited(retry_after)
+            raise RateLimited(retry_after)
+        response.raise_for_status()
+        self.bucket.on_success()
+        return response
+
+    async def _lookup(self, uuid):
+        data = (await self._get(REPLAY_DATA_URL, {"uuid": uuid})).json()
+        if len(data["games"]) != 1:
+            return None
+        return data["games"][0]["id"]
+
+    async def _fetch(self, game_id):
+        response = await self._get(GAME_FILE_URL, {"gameId": game_id})
+        return [line for line in response.content.splitlines() if line]
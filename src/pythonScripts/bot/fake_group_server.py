@@ -0,0 +1,109 @@
+import argparse
+import ast
+import asyncio
+import itertools
+import json
+import re
+
+import websockets
+
+# a ws.txt line: "2025-01-01 12:00:00 - INFO - RECV: (3) ['chat', {...}]"
+RECV_LINE = re.compile(r"RECV: \([^)]*\) (.*)$")
+
+
+def load_frames(path):
+    """[event, data] frames from a file of JSON arrays, one per line, or from the bot's ws.jsonl or older ws.txt log"""
+    frames = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("["):
+                frames.append(json.loads(line))
+                continue
+            if line.startswith("{"):  # ws.jsonl record
+                record = json.loads(line)
+                if record.get("direction") == "recv" and isinstance(record.get("data"), list) and len(record["data"]) >= 2:
+                    frames.append(record["data"])
+                continue
+            match = RECV_LINE.search(line)
+            if match is None:
+                continue
+            try:
+                msg = ast.literal_eval(match.group(1))
+            except (ValueError, SyntaxError):
+                continue
+            if isinstance(msg, list) and len(msg) >= 2:
+                frames.append(msg)
+    return frames
+
+
+class FakeGroupServer:
+    """local group socket that replays recorded frames and echoes chat"""
+
+    def __init__(self, frames, interval=0.5, ping_interval=25, bot_name="Bot"):
+        self.frames = frames
+        self.interval = interval
+        self.ping_interval = ping_interval
+        self.bot_name = bot_name
+        self.received = []
+        self.sids = itertools.count()
+
+    async def handler(self, ws):
+        sid = f"fake{next(self.sids)}"
+        await ws.send("0" + json.dumps({
+            "sid": sid, "upgrades": [], "pingInterval": self.ping_interval * 1000,
+            "pingTimeout": 20000, "maxPayload": 1000000
+        }))
+        tasks = [asyncio.create_task(self.ping(ws))]
+        try:
+            async for message in ws:
+                if message.startswith("40/"):
+                    namespace = message[2:].split(",", 1)[0]
+                    await ws.send(f"40{namespace}," + json.dumps({"sid": sid}))
+                    tasks.append(asyncio.create_task(self.replay(ws, namespace)))
+                elif message.startswith("42/"):
+                    namespace, payload = message[2:].split(",", 1)
+                    msg = json.loads(payload)
+                    self.received.append(msg)
+                    print("RECV", msg)
+                    if msg[0] == "chat":
+                        await self.emit(ws, namespace, ["chat", {"from": self.bot_name, "message": msg[1]}])
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def ping(self, ws):
+        while True:
+            await asyncio.sleep(self.ping_interval)
+            await ws.send("2")
+
+    async def replay(self, ws, namespace):
+        for frame in self.frames:
+            await asyncio.sleep(self.interval)
+            await self.emit(ws, namespace, frame)
+
+    @staticmethod
+    async def emit(ws, namespace, msg):
+        await ws.send(f"42{namespace}," + json.dumps(msg))
+
+    async def serve(self, host="localhost", port=8765):
+        async with websockets.serve(self.handler, host, port):
+            await asyncio.Future()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded group frames to a local SocketAdapter")
+    parser.add_argument("frames", help="ws.jsonl or ws.txt log, or a file of JSON [event, data] arrays, one per line")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--interval", type=float, default=0.5, help="Seconds between replayed frames")
+    args = parser.parse_args()
+
+    frames = load_frames(args.frames)
+    print(f"Replaying {len(frames)} frames on ws://localhost:{args.port}/socket.io/?EIO=4&transport=websocket")
+    asyncio.run(FakeGroupServer(frames, interval=args.interval).serve(port=args.port))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+import argparse
+import asyncio
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import http_client
+from leader import DriverAdapter, TagproBot
+from maps import start_catalog_refresher
+from stats_store import get_wr_index
+
+
+class BotHost:
+    """runs several bots in one process, each step on its own thread"""
+
+    def __init__(self, bots, catalog_refresh=21600, catalog_jitter=0.1):
+        self.bots = bots
+        for bot in bots:
+            bot.adapter.set_lobby(bot.room_name)  # the bots share events.txt and ws.jsonl
+        self.catalog_refresh = catalog_refresh
+        self.catalog_jitter = catalog_jitter
+        self.executor = ThreadPoolExecutor(max_workers=max(1, len(bots)), thread_name_prefix="bot")
+
+    async def run_bot(self, bot):
+        loop = asyncio.get_running_loop()
+        bot.start()
+        while True:
+            try:
+                await loop.run_in_executor(self.executor, bot.step)
+            except Exception as e:
+                # one lobby failing should not take the others down
+                bot.adapter.event_log.exception(f"step failed: {e}")
+                await asyncio.sleep(1)
+
+    async def report(self, interval=600):
+        while True:
+            await asyncio.sleep(interval)
+            print(time.strftime("%H:%M:%S"), "http:", http_client.latency_stats())
+
+    async def run(self):
+        # warm the shared state once, before the bots race to fill it
+        await asyncio.to_thread(start_catalog_refresher, self.catalog_refresh, self.catalog_jitter)
+        await asyncio.to_thread(get_wr_index().refresh)
+        await asyncio.gather(self.report(), *(self.run_bot(bot) for bot in self.bots))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run one group bot per region in a single process")
+    parser.add_argument(
+        "regions", nargs="*", default=["east"], choices=list(TagproBot.region_map),
+        help="Regions to open a lobby in (default: east)"
+    )
+    parser.add_argument("--room-name", default=TagproBot.room_name, help="Group name; the region is appended when hosting several")
+    parser.add_argument("--catalog-refresh", type=float, default=21600, help="Seconds between map sheet refreshes")
+    parser.add_argument("--catalog-jitter", type=float, default=0.1, help="Random +/- fraction of the refresh interval")
+    parser.add_argument(
+        "--group-ids", nargs="+",
+        help="Join these existing groups over bare websockets instead of Chrome, one per region in order"
+    )
+    parser.add_argument("--socket-url", help="Websocket URL for --group-ids, e.g. the fake_group_server.py URL")
+    parser.add_argument("--cookie", help="tagpro session cookie for --group-ids, as 'tagpro=...'")
+    args = parser.parse_args()
+    if args.group_ids is not None and len(args.group_ids) != len(args.regions):
+        parser.error("--group-ids needs one group id per region")
+
+    if args.group_ids is None:
+        make_adapters = [DriverAdapter for _ in args.regions]
+    else:
+        from socket_adapter import SOCKET_URL, SocketAdapter  # needs websocket-client
+
+        make_adapters = [
+            functools.partial(SocketAdapter, group_id, args.socket_url or SOCKET_URL, args.cookie)
+            for group_id in args.group_ids
+        ]
+    bots = []
+    for region, make_adapter in zip(args.regions, make_adapters):
+        room_name = args.room_name if len(args.regions) == 1 else f"{args.room_name} ({region.upper()})"
+        bots.append(TagproBot(make_adapter(), room_name=room_name, region=TagproBot.region_map[region]))
+    asyncio.run(BotHost(bots, args.catalog_refresh, args.catalog_jitter).run())
+
+
+if __name__ == "__main__":
+    main()
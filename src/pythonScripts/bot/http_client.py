@@ -0,0 +1,127 @@
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# one keep-alive session for every script, so repeat calls to the same host skip the TCP+TLS handshake
+DEFAULT_TIMEOUT = 30
+HOST_CONCURRENCY = {"tagpro.koalabeast.com": 8, "docs.google.com": 2}
+DEFAULT_HOST_CONCURRENCY = 4
+
+_session = None
+_session_lock = threading.Lock()
+_host_slots = {}
+_stats = defaultdict(lambda: {"count": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0})
+_stats_lock = threading.Lock()
+
+
+def get_session():
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            session.headers["Accept-Encoding"] = "gzip, deflate"
+            # connection errors and 5xx are retried here; 429s are left to callers, who know how to back off.
+            # urllib3 would otherwise retry any 429 with a Retry-After header, sleeping in the host's slot
+            retry = Retry(
+                total=3,
+                backoff_factor=0.5,
+                status_forcelist=(500, 502, 503, 504),
+                allowed_methods=frozenset({"GET"}),
+                raise_on_status=False,
+                respect_retry_after_header=False,
+            )
+            adapter = HTTPAdapter(pool_connections=8, pool_maxsize=16, max_retries=retry)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _session = session
+        return _session
+
+
+def _slots(host):
+    with _session_lock:
+        if host not in _host_slots:
+            _host_slots[host] = threading.BoundedSemaphore(HOST_CONCURRENCY.get(host, DEFAULT_HOST_CONCURRENCY))
+        return _host_slots[host]
+
+
+def request(method, url, **kwargs):
+    """session.request with a default timeout, a per-host concurrency cap and latency stats per endpoint"""
+    kwargs.setdefault("timeout", DEFAULT_TIMEOUT)
+    parts = urlsplit(url)
+    endpoint = f"{method} {parts.netloc}{parts.path}"
+    error = False
+    start = time.perf_counter()
+    with _slots(parts.netloc):
+        try:
+            return get_session().request(method, url, **kwargs)
+        except requests.RequestException:
+            error = True
+            raise
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            with _stats_lock:
+                stats = _stats[endpoint]
+                stats["count"] += 1
+                stats["errors"] += error
+                stats["total_ms"] += elapsed_ms
+                stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request("POST", url, **kwargs)
+
+
+def latency_stats():
+    with _stats_lock:
+        return {
+            endpoint: {
+                "count": s["count"],
+                "errors": s["errors"],
+                "mean_ms": round(s["total_ms"] / s["count"], 1),
+                "max_ms": round(s["max_ms"], 1),
+            }
+            for endpoint, s in _stats.items()
+        }
+
+
+def check_rate_limit_passthrough():
+    """a 429 with Retry-After must reach the caller after exactly one request"""
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+    hits = []
+
+    class RateLimitedHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            hits.append(self.path)
+            self.send_response(429)
+            self.send_header("Retry-After", "1")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), RateLimitedHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        start = time.perf_counter()
+        response = get(f"http://127.0.0.1:{server.server_port}/")
+        elapsed = time.perf_counter() - start
+    finally:
+        server.shutdown()
+    assert response.status_code == 429, response.status_code
+    assert len(hits) == 1, f"{len(hits)} requests for one get"
+    print(f"429 returned after {len(hits)} request in {elapsed:.2f}s")
+
+
+if __name__ == "__main__":
+    check_rate_limit_passthrough()
@@ -1,31 +1,27 @@
 import datetime as dt
 import time
-import logging
 import json
 import random
 from selenium import webdriver
 from selenium.webdriver.common.by import By
-from selenium.common.exceptions import JavascriptException
+from selenium.common.exceptions import JavascriptException, WebDriverException
 
-from rapidfuzz import fuzz
+from rapidfuzz import fuzz, process
 
 from replay_manager import write_replay_uuid, get_wr_entry
-from maps import inject_map_id_into_preset, get_maps
+from maps import inject_map_id_into_preset, get_catalog, default_float, start_catalog_refresher
+from map_search import get_map_search
+from preset_codec import preset_error
+from metrics import metrics
+from bot_logging import LobbyAdapter, setup_logger
 
 
-def setup_logger(name, filename):
-    logger = logging.getLogger(name)
-    logger.setLevel(logging.INFO)
-    handler = logging.FileHandler(filename)
-    formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s", "%Y-%m-%d %H:%M:%S")
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
-    return logger
-
+# frame types to log only one in N of; anything not listed is logged in full
+WS_LOG_SAMPLE_RATES = {}
 
 # Create two loggers
 event_logger = setup_logger("events_logger", "events.txt")
-ws_logger = setup_logger("ws_logger", "ws.txt")
+ws_logger = setup_logger("ws_logger", "ws.jsonl", structured=True, sample_rates=WS_LOG_SAMPLE_RATES)
 
 
 discord_link = "discord.gg/Y3MZYdxV"
@@ -49,13 +45,6 @@ def timedelta_str(td):
     return f"{td.seconds//3600:02d}:" * (td.total_seconds() >= 3600) + f"{(td.seconds%3600)//60:02d}:{td.seconds%60:02d}.{td.microseconds//1000:03d}"
 
 
-def default_float(s, default=None):
-    try:
-        return float(s)
-    except ValueError:
-        return default
-
-
 PERIODIC_MESSAGES = [
     # Promotion
     f"Dont forget to join the GLTP Discord server! {discord_link}",
@@ -67,7 +56,7 @@ PERIODIC_MESSAGES = [
     # docs
     "If you want a new map go back to group and Ill load a fresh one!",
     "This lobby is open 24/7, but the best time to join is 10PM Eastern.",
-    f"The bot cycles through maps from this spreadsheet:\ndocs.google.com/spreadsheets/d/1OnuTCekHKCD91W39jXBG4uveTCCyMxf9Ofead43MMCU\nThere are currently {len(get_maps())} maps in rotation!",
+    f"The bot cycles through maps from this spreadsheet:\ndocs.google.com/spreadsheets/d/1OnuTCekHKCD91W39jXBG4uveTCCyMxf9Ofead43MMCU\nThere are currently {len(get_catalog())} maps in rotation!",
     "Map too hard? \"SETTINGS difficulty 1 3\"  Too easy? \"SETTINGS difficulty 4 7\"",
     "Use \"SETTINGS category yourcategory\" to play specific map types!\nCategories include buddy, mars, non-grav, race, unlimited, tower, and more!",
     f"Please file bug reports and feature requests in the #bug-reports-and-suggestions room in {discord_link}",
@@ -110,10 +99,158 @@ PERIODIC_MESSAGES = [
     "Current Gravity Map ELOs (based on previous 180 days)\n- Goated Muted SB: 1463\n- Dad: 1389\n- Unity: 1240\n- Madoka: 1235",
     "Quota for INFO command exceeded, ignoring INFO requests for next 48 hours",
 ]
+PERIODIC_MESSAGES_LOWER = [m.lower() for m in PERIODIC_MESSAGES]  # INFO search choices
+CHAT_COMMANDS = ("HELP", "LAUNCHNEW", "SETTINGS", "MAP", "INFO", "MODERATE", "REGION")
+
+
+GROUPS_URL = "https://tagpro.koalabeast.com/groups/"
+
+
+class CountingChrome(webdriver.Chrome):
+    """Chrome driver that times every WebDriver round trip; element calls go through execute too"""
+
+    def execute(self, driver_command, params=None):
+        metrics.count("webdriver.calls")
+        with metrics.timer(f"webdriver.{driver_command}"):
+            return super().execute(driver_command, params)
+
+
+class GroupAdapter:
+    """roster and outbound queue of a group connection; subclasses supply the transport"""
+
+    settings_ttl = 60  # unchanged settings are re-sent this often, in case someone else changed them
+    LOBBY_LISTS = ("red-team", "blue-team", "spectators", "waiting")
+    TEAM_LISTS = {1: "red-team", 2: "blue-team", 3: "spectators"}  # any other team value is "waiting"
+
+    def __init__(self):
+        self.my_id = None
+        self.event_handlers = {}
+        self.members = {}  # group member id -> {"name", "location", "team"}
+        self.group_id = None
+        self.outbox = []
+        self.sent_settings = {}  # setting name -> (value, monotonic time sent)
+        self.frame_received = None  # when the frames being dispatched reached the bot
+        self.command_received = None  # when the chat command being handled arrived, until something is sent back
+        self.event_log = event_logger
+        self.ws_log = ws_logger
+
+    def set_lobby(self, lobby):
+        """tag this connection's log records with lobby, so bots sharing a process can be told apart"""
+        self.event_log = LobbyAdapter(event_logger, {"lobby": lobby})
+        self.ws_log = LobbyAdapter(ws_logger, {"lobby": lobby})
+
+    def dispatch(self, msg):
+        """hand one decoded [event, data] frame to the roster and event_handlers"""
+        if isinstance(msg, list) and len(msg) >= 2:
+            event_type, event_details = msg[0], msg[1]
+            event_key = f"ws_{event_type}"
+            if event_key == "ws_member" and isinstance(event_details, dict) and "id" in event_details:
+                self.update_member(event_details)
+            elif event_key == "ws_removed":
+                self.remove_member(event_details)
+            if event_key in self.event_handlers:
+                with metrics.timer(f"handler.{event_key}"):
+                    self.event_handlers[event_key](event_details)
+            elif event_key == "ws_you":
+                self.my_id = event_details
+
+    def log_frame(self, direction, msg, socket=None):
+        # the frame is serialized on the log writer thread, not here
+        event = msg[0] if isinstance(msg, list) and msg else None
+        self.ws_log.info(direction.upper(), extra={"direction": direction, "socket": socket, "event": event, "data": msg})
+
+    def observe_url(self, url):
+        """cache the group id from the current page; a new group starts with a clean settings cache"""
+        group_id = None
+        if url.startswith(GROUPS_URL):
+            group_id = url.strip('/').split('/')[-1]
+            if group_id == "groups":  # the group list, not a group
+                group_id = None
+        if group_id != self.group_id:
+            self.group_id = group_id
+            self.sent_settings = {}
+
+    def queue_ws_message(self, contents: list):
+        self.outbox.append(contents)
+
+    def queue_setting(self, name, value):
+        """queue a group setting unless the same value was sent within settings_ttl seconds"""
+        now = time.monotonic()
+        last = self.sent_settings.get(name)
+        if last is not None and last[0] == value and now - last[1] < self.settings_ttl:
+            return
+        self.sent_settings[name] = (value, now)
+        self.queue_ws_message(["setting", {"name": name, "value": value}])
+
+    def flush_ws_messages(self):
+        """send every queued message in one batch"""
+        messages, self.outbox = self.outbox, []
+        if messages and self.group_id is None:  # joined since the last ensure_in_group
+            self.observe_url(self.current_url())
+        # Only send if on a group page
+        if not messages or self.group_id is None:
+            return
+        for contents in messages:
+            self.log_frame("send", contents)
+        frames = [f'42/groups/{self.group_id},{json.dumps(contents)}' for contents in messages]
+        if not self.send_frames(frames):
+            print("no websocket")
+            self.group_id = None  # re-read from the page on the next flush
+            self.sent_settings = {}
+            return
+        metrics.count("ws.sent", len(frames))
+        if self.command_received is not None:
+            metrics.observe("chat_to_reply", (time.monotonic() - self.command_received) * 1000)
+            self.command_received = None
+
+    def send_ws_message(self, contents: list):
+        self.queue_ws_message(contents)
+        self.flush_ws_messages()
+
+    def send_chat_msg(self, text: str):
+        for line in text.split("\n"):
+            self.queue_ws_message(["chat", line])
+        self.flush_ws_messages()
+
+    def update_member(self, details):
+        if details["id"] not in self.members and details.get("name"):
+            self.members.pop(("page", details["name"]), None)  # placeholder from sync_roster
+        member = self.members.setdefault(details["id"], {"name": "", "location": "", "team": None})
+        for key in ("name", "location", "team"):
+            if key in details:
+                member[key] = details[key]
+
+    def remove_member(self, details):
+        self.members.pop(details.get("id") if isinstance(details, dict) else details, None)
+
+    def reset_roster(self):
+        self.members = {}
+
+    def sync_roster(self, lobby_players):
+        """replace the roster with one shaped like scrape_lobby_players, keeping member ids matched by name"""
+        ids_by_name = {member["name"]: member_id for member_id, member in self.members.items()}
+        teams = {team_list: team for team, team_list in self.TEAM_LISTS.items()}
+        members = {}
+        for team_list, players in lobby_players.items():
+            for p in players:
+                member_id = ids_by_name.get(p["name"], ("page", p["name"]))
+                members[member_id] = {"name": p["name"], "location": p["location"], "team": teams.get(team_list)}
+        self.members = members
+
+    def get_lobby_players(self):
+        """lobby roster kept from member/removed frames, in the same shape as scrape_lobby_players"""
+        lobby_players = {team: [] for team in self.LOBBY_LISTS}
+        for member in self.members.values():
+            team = self.TEAM_LISTS.get(member["team"], "waiting")
+            lobby_players[team].append({"name": member["name"], "location": member["location"]})
+        return lobby_players
 
 
-class DriverAdapter:
+class DriverAdapter(GroupAdapter):
+    """group connection through a headless Chrome, reading and writing the page's own websocket"""
+
     def __init__(self):
+        super().__init__()
         options = webdriver.ChromeOptions()
         options.add_argument("--headless")
         options.add_argument("--disable-gpu")
@@ -124,19 +261,18 @@ class DriverAdapter:
         options.add_argument("--disable-popup-blocking")
         options.set_capability("goog:chromeOptions", {"prefs": {"profile.default_content_setting_values.popups": 0}})
         options.set_capability("unhandledPromptBehavior", "dismiss")
-        self.driver = webdriver.Chrome(options=options)
+        self.driver = CountingChrome(options=options)
+        self.driver.set_script_timeout(30)
         self.inject_ws_intercept()
         self.inject_auto_close_alerts()
 
-        self.my_id = None
-        self.event_handlers = {}
-
     def inject_ws_intercept(self):
         ws_injection_script = """
         if (!window.myWebSockets) {
             window.myWebSockets = {};
             window.myWsMessages = {};
             window.myWsCounter = 0;
+            window.myWsWaiter = null;
             const OriginalWebSocket = window.WebSocket;
             window.WebSocket = function(url, protocols) {
                 const ws = protocols ? new OriginalWebSocket(url, protocols) : new OriginalWebSocket(url);
@@ -158,6 +294,11 @@ class DriverAdapter:
                         parsed = message;
                     }
                     window.myWsMessages[ws._id].push(parsed);
+                    if (window.myWsWaiter) {
+                        const waiter = window.myWsWaiter;
+                        window.myWsWaiter = null;
+                        waiter();
+                    }
                 });
                 return ws;
             };
@@ -187,66 +328,84 @@ class DriverAdapter:
         """
         self.driver.execute_cdp_cmd("Page.addScriptToEvaluateOnNewDocument", {"source": alert_injection_script})
 
-    def process_ws_events(self):
-        ws_messages = self.driver.execute_script("""
-            var messagesCopy = {};
-            for (var id in window.myWsMessages) {
-                messagesCopy[id] = window.myWsMessages[id].slice();
-                window.myWsMessages[id] = [];
-            }
-            return messagesCopy;
-        """)
+    def process_ws_events(self, timeout=0.0):
+        """dispatch received frames, waiting up to timeout seconds for the first one"""
+        try:
+            ws_messages = self.driver.execute_async_script("""
+                var done = arguments[arguments.length - 1];
+                var timeoutMs = arguments[0];
+                function drain() {
+                    var messagesCopy = {};
+                    for (var id in window.myWsMessages) {
+                        messagesCopy[id] = window.myWsMessages[id].slice();
+                        window.myWsMessages[id] = [];
+                    }
+                    done(messagesCopy);
+                }
+                var pending = Object.values(window.myWsMessages || {}).some(function(msgs) { return msgs.length; });
+                if (pending || timeoutMs <= 0) {
+                    drain();
+                    return;
+                }
+                if (!window.myWsMessages) {  // no intercept on this page, just wait out the timeout
+                    setTimeout(drain, timeoutMs);
+                    return;
+                }
+                var timer = setTimeout(function() { window.myWsWaiter = null; drain(); }, timeoutMs);
+                // short grace period so a burst of frames is delivered together
+                window.myWsWaiter = function() { clearTimeout(timer); setTimeout(drain, 20); };
+            """, int(timeout * 1000))
+        except WebDriverException as e:  # page navigated away mid-wait
+            self.event_log.info(f"ws wait interrupted: {e.msg}")
+            time.sleep(timeout)
+            return
+        self.frame_received = time.monotonic()
         for msg_key, msgs in ws_messages.items():
             for msg in msgs:
-                ws_logger.info(f"RECV: ({msg_key}) {msg}")
-                if isinstance(msg, list) and len(msg) >= 2:
-                    event_type, event_details = msg[0], msg[1]
-                    event_key = f"ws_{event_type}"
-                    if event_key in self.event_handlers:
-                        self.event_handlers[event_key](event_details)
-                    elif event_key == "ws_you":
-                        self.my_id = event_details
-        return
+                self.log_frame("recv", msg, msg_key)
+                self.dispatch(msg)
 
-    def send_ws_message(self, contents: list):
-        ws_logger.info(f"SEND: {contents}")
-        ws_ids = self.driver.execute_script("return Object.keys(window.myWebSockets);")
-        if not ws_ids:
-            print("no websocket")
-            return
-        ws_id = ws_ids[-1]
-        # Only send if on a group page
-        if not self.driver.current_url.startswith("https://tagpro.koalabeast.com/groups/"):
-            return
-        group_id = self.driver.current_url.strip('/').split('/')[-1]
-        message = f'42/groups/{group_id},{json.dumps(contents)}'
+    def send_frames(self, frames):
+        """send frames with one script execution, on the newest socket of the page, if it is still the group's page"""
         try:
-            self.driver.execute_script(
+            return self.driver.execute_script(
                 """
-                var ws = window.myWebSockets[arguments[0]];
-                if (ws && ws.readyState === WebSocket.OPEN) {
-                    ws.send(arguments[1]);
-                } else {
-                    console.warn("Cannot send message: WebSocket not found or not open.", ws, ws.readyState);
+                if (location.href.replace(/\/+$/, "") !== arguments[1]) {
+                    console.warn("Cannot send message: not on the group page.", location.href);
+                    return false;
                 }
+                var ids = Object.keys(window.myWebSockets || {});
+                var ws = ids.length ? window.myWebSockets[ids[ids.length - 1]] : null;
+                if (!ws || ws.readyState !== WebSocket.OPEN) {
+                    console.warn("Cannot send message: WebSocket not found or not open.", ws);
+                    return false;
+                }
+                for (var frame of arguments[0]) {
+                    ws.send(frame);
+                }
+                return true;
                 """,
-                ws_id, message
+                frames, GROUPS_URL + self.group_id
             )
         except JavascriptException as e:
-            event_logger.error(str(e))
+            self.event_log.error(str(e))
             print("TODO: LOOK INTO THIS", e)
+            return False
 
-    def get_lobby_players(self):
-        teams = ["red-team", "blue-team", "spectators", "waiting"]
-        lobby_players = {team: self.driver.execute_script(f"""
-            return Array.from(document.querySelectorAll("#{team} li.player-item")).map(el => {{
-                return {{
-                    name: el.querySelector('.player-name') ? el.querySelector('.player-name').innerText : "",
-                    location: el.querySelector('.player-location') ? el.querySelector('.player-location').innerText : ""
-                }};
-            }});
-        """) for team in teams}
-        return lobby_players
+    def scrape_lobby_players(self):
+        """roster as shown in the page, used to check the frame-built roster"""
+        return self.driver.execute_script("""
+            var lobbyPlayers = {};
+            for (var team of arguments[0]) {
+                lobbyPlayers[team] = Array.from(document.querySelectorAll("#" + team + " li.player-item")).map(el => {
+                    return {
+                        name: el.querySelector('.player-name') ? el.querySelector('.player-name').innerText : "",
+                        location: el.querySelector('.player-location') ? el.querySelector('.player-location').innerText : ""
+                    };
+                });
+            }
+            return lobbyPlayers;
+        """, list(self.LOBBY_LISTS))
 
     def find_elements(self, css_selector: str):
         return self.driver.find_elements(By.CSS_SELECTOR, css_selector)
@@ -256,13 +415,48 @@ class DriverAdapter:
         join_game_btns = self.find_elements("#join-game-btn")
         return any(b.is_displayed() for b in join_game_btns)
 
-    def send_chat_msg(self, text: str):
-        for line in text.split("\n"):
-            self.send_ws_message(["chat", line])
+    def current_url(self):
+        return self.driver.current_url
+
+    def open_group_list(self):
+        self.reset_roster()
+        self.group_id = None
+        self.driver.get(GROUPS_URL)
+
+    def join_or_create_group(self, room_name):
+        """from the group list, join the group called room_name (returns True) or click create"""
+        group_items = self.find_elements("div.group-item")
+        for group in group_items:
+            if group.find_element(By.CSS_SELECTOR, ".group-name").text.strip() == room_name:
+                join_button = group.find_element(By.CSS_SELECTOR, "a.btn.btn-primary.pull-right")
+                self.reset_roster()
+                self.group_id = None
+                join_button.click()
+                time.sleep(1)
+                return True
+        # create group
+        create_btns = self.find_elements("#create-group-btn")
+        if create_btns:
+            self.reset_roster()
+            self.group_id = None
+            create_btns[0].click()
+        return False
+
+    def read_game_uuid(self):
+        """uuid of the game the page is in, or None if the client never reports it"""
+        for _ in range(5):
+            client_info = self.driver.execute_script("return tagpro.clientInfo;")
+            if client_info is not None:
+                return client_info["gameUuid"]
+            time.sleep(1)
+        return None
+
+    def pug_available(self):
+        return any([b.is_displayed() for b in self.find_elements("#pug-btn")])
 
 
 class TagproBot:
-    URL = "https://tagpro.koalabeast.com/groups/"
+    URL = GROUPS_URL
     room_name = "Gravity and Fun Mini Games"
     default_map_settings = {"category": None, "difficulty": (1.0, 3.5), "minfun": 3.0}
     default_lobby_settings = {"region": "US East"}
@@ -270,10 +464,14 @@ class TagproBot:
     restricted_names = ["Fap", "Ptuh"]
     region_map = {"east": "US East", "central": "US Central", "west": "US West", "eu": "Europe", "oce": "Oceanic"}
 
-    def __init__(self, adapter: DriverAdapter):
+    def __init__(self, adapter: GroupAdapter, room_name=None, region=None):
         self.adapter = adapter
+        if room_name is not None:
+            self.room_name = room_name
         self.settings = dict(self.default_map_settings)
         self.lobby_settings = dict(self.default_lobby_settings)
+        if region is not None:
+            self.lobby_settings["region"] = region
 
         self.authed_members = {}
 
@@ -285,6 +483,7 @@ class TagproBot:
         self.current_game_preset = None
         self.current_game_uuid = None
         self.game_is_active = False
+        self.info_cards = {}  # preset -> (catalog, WR uuid, card parts), see info_card
         ###
 
         self.adapter.event_handlers["ws_chat"] = self.handle_chat
@@ -296,10 +495,27 @@ class TagproBot:
     def game_str(self):
         if self.current_game_preset is None:
             return "No current game preset set."
-        curr_maps = [m for m in get_maps() if m["preset"] == self.current_game_preset]
-        if not curr_maps:
-            return f"Sorry, I don't know the MAP details for {self.current_game_preset}"
-        details = curr_maps[0]
+        return self.info_card(self.current_game_preset)
+
+    def info_card(self, preset):
+        """map details and WR for a preset, cached per preset"""
+        catalog = get_catalog()
+        details = catalog.by_preset.get(preset)
+        if details is None:
+            return f"Sorry, I don't know the MAP details for {preset}"
+        wr = get_wr_entry(details['map_id'])
+        wr_uuid = wr['uuid'] if wr else None
+        cached = self.info_cards.get(preset)
+        if cached is None or cached[0] is not catalog or cached[1] != wr_uuid:
+            cached = self.info_cards[preset] = (catalog, wr_uuid, self.build_info_card(details, wr))
+        head, wr_timestamp, tail = cached[2]
+        if wr_timestamp is None:
+            return head
+        return head + time_since(wr_timestamp) + tail
+
+    @staticmethod
+    def build_info_card(details, wr):
+        """(text before the WR's time since, WR timestamp or None, text after it)"""
         msgs = [
             f"Playing '{details['name']}', Difficulty: {details['difficulty']},",
             f"Map ID: {details['map_id']}, Preset: {details['preset']}"
@@ -307,20 +523,19 @@ class TagproBot:
         if default_float(details['balls_req'], 100) > 1.0:
             msgs.append(f"YOU NEED {details['balls_req']} BALLS TO COMPLETE THIS MAP!")
 
-        wr = get_wr_entry(details['map_id'])
-        if wr:
-            msgs.append(
-                "WR: " + timedelta_str(dt.timedelta(seconds=wr['record_time'] / 1000)) +
-                f" (Cap by {wr['capping_player']}) " +
-                ("(Solo)" if wr['players'] == 1 else f"+{len(wr['players'])} others") +
-                " | " + time_since(wr['timestamp']) +
-                " | " + f"({details['caps_to_win'] or 1} cap(s) to finish)"
-            )
-            if wr['capping_player_quote']:
-                msgs.append(f"WR Quote: '{wr['capping_player_quote']}'")
-        else:
+        if not wr:
             msgs.append("(No world record less than 60 minutes recorded for this map)")
-        return "\n".join(msgs)
+            return "\n".join(msgs), None, ""
+        msgs.append(
+            "WR: " + timedelta_str(dt.timedelta(seconds=wr['record_time'] / 1000)) +
+            f" (Cap by {wr['capping_player']}) " +
+            ("(Solo)" if wr['players'] == 1 else f"+{len(wr['players'])} others") +
+            " | "
+        )
+        tail = " | " + f"({details['caps_to_win'] or 1} cap(s) to finish)"
+        if wr['capping_player_quote']:
+            tail += "\n" + f"WR Quote: '{wr['capping_player_quote']}'"
+        return "\n".join(msgs), wr['timestamp'], tail
 
     @property
     def num_ready_balls(self):
@@ -334,7 +549,8 @@ class TagproBot:
 
     def ensure_in_group(self, room_name):
         """Ensures the browser is in the desired group by room name."""
-        current_url = self.adapter.driver.current_url
+        current_url = self.adapter.current_url()
+        self.adapter.observe_url(current_url)
 
         if current_url == "https://tagpro.koalabeast.com/games/find":
             if self.finding_game_start_time is None:
@@ -348,59 +564,48 @@ class TagproBot:
             return
         self.finding_game_start_time = None
 
-        if current_url == "https://tagpro.koalabeast.com/groups/":
-            group_items = self.adapter.find_elements("div.group-item")
-            for group in group_items:
-                if group.find_element(By.CSS_SELECTOR, ".group-name").text.strip() == room_name:
-                    join_button = group.find_element(By.CSS_SELECTOR, "a.btn.btn-primary.pull-right")
-                    join_button.click()
-                    time.sleep(1)
-                    return True
-            else:
-                # create group
-                create_btns = self.adapter.find_elements("#create-group-btn")
-                if create_btns:
-                    create_btns[0].click()
+        if current_url == GROUPS_URL:
+            if self.adapter.join_or_create_group(room_name):
+                return True
 
-        elif not current_url.startswith("https://tagpro.koalabeast.com/groups/"):
+        elif not current_url.startswith(GROUPS_URL):
             if current_url == "https://tagpro.koalabeast.com/game":
-                for _ in range(5):
-                    client_info = self.adapter.driver.execute_script("return tagpro.clientInfo;")
-                    if client_info is not None:
-                        self.current_game_uuid = client_info["gameUuid"]
-                        event_logger.info(f"Game UUID: {self.current_game_uuid}")
-                        write_replay_uuid(self.current_game_uuid)
-                        break
-                    time.sleep(1)
+                game_uuid = self.adapter.read_game_uuid()
+                if game_uuid is not None:
+                    self.current_game_uuid = game_uuid
+                    self.adapter.event_log.info(f"Game UUID: {self.current_game_uuid}")
+                    write_replay_uuid(self.current_game_uuid)
                 else:
                     print("FAILED TO GET CLIENTINFO")
 
-            self.adapter.driver.get("https://tagpro.koalabeast.com/groups/")
+            self.adapter.open_group_list()
 
         else:  # currently in group, ensure sane state
-            self.adapter.send_ws_message(["setting", {"name": "groupName", "value": room_name}])
-            self.adapter.send_ws_message(["setting", {"name": "serverSelect", "value": "false"}])
-            self.adapter.send_ws_message(["setting", {"name": "regions", "value": self.lobby_settings["region"]}])
-            self.adapter.send_ws_message(["setting", {"name": "discoverable", "value": "true"}])
-            if self.adapter.my_id is not None:
-                self.adapter.send_ws_message(["team", {"id": self.adapter.my_id, "team": 3}])
+            self.adapter.queue_setting("groupName", room_name)
+            self.adapter.queue_setting("serverSelect", "false")
+            self.adapter.queue_setting("regions", self.lobby_settings["region"])
+            self.adapter.queue_setting("discoverable", "true")
+            my_member = self.adapter.members.get(self.adapter.my_id)
+            if self.adapter.my_id is not None and (my_member is None or my_member["team"] != 3):
+                self.adapter.queue_ws_message(["team", {"id": self.adapter.my_id, "team": 3}])
             try:
-                if any([b.is_displayed() for b in self.adapter.find_elements("#pug-btn")]):
-                    self.adapter.send_ws_message(["pug"])
-                    self.adapter.send_ws_message(["setting", {"name": "isPrivate", "value": "true"}])
+                if self.adapter.pug_available():
+                    self.adapter.queue_ws_message(["pug"])
+                    self.adapter.queue_setting("isPrivate", "true")
             except Exception as e:
                 print("FAILED HERE")
                 print("----")
                 print(e)
                 print("----")
+            self.adapter.flush_ws_messages()
 
     def handle_game(self, event_details):
         if event_details.get("gameId") is None:
-            event_logger.info(f"End of game: {self.current_game_preset}")
+            self.adapter.event_log.info(f"End of game: {self.current_game_preset}")
             self.game_is_active = False
             self.adapter.send_chat_msg("GG. Loading next map. Please return to lobby.")
         else:
-            event_logger.info(f"Game Running: {self.current_game_preset}")
+            self.adapter.event_log.info(f"Game Running: {self.current_game_preset}")
             self.ensure_in_group(self.room_name)
             if not self.game_is_active:
                 self.game_is_active = True
@@ -417,27 +622,46 @@ class TagproBot:
             return
 
         self.lobby_players = lobby_players
-        event_logger.info(f"(Red) Ready balls: {self.num_ready_balls}")
-        event_logger.info(f"Lobby Players: {lobby_players}")
+        self.adapter.event_log.info(f"(Red) Ready balls: {self.num_ready_balls}")
+        self.adapter.event_log.info(f"Lobby Players: {lobby_players}")
 
         # reset to default if no users
         if self.num_in_lobby == 1:
             self.settings = dict(self.default_map_settings)
-            event_logger.info("Empty lobby, reverting to default settings.")
+            self.adapter.event_log.info("Empty lobby, reverting to default settings.")
+
+    def check_lobby_players(self):
+        """compare the frame-built roster with the page and trust the page if they disagree"""
+        def normalized(lobby_players):
+            return {team: sorted((p["name"], p["location"]) for p in players) for team, players in lobby_players.items()}
+
+        scraped = self.adapter.scrape_lobby_players()
+        if normalized(scraped) != normalized(self.adapter.get_lobby_players()):
+            self.adapter.event_log.warning(f"Roster out of sync, page shows: {scraped}")
+            self.adapter.sync_roster(scraped)
+            self.handle_team_change(None)
 
     def handle_chat(self, event_details):
+        try:
+            self._handle_chat(event_details)
+        finally:
+            self.adapter.command_received = None  # a command that got no reply leaves no chat_to_reply sample
+
+    def _handle_chat(self, event_details):
         msg = event_details.get("message", "")
         if msg in [
             "Please move some or all players to one of the teams and try again.",
             "All of the players are in the Waiting or Spectators area."
         ]:
             return
-        event_logger.info("Chat: " + str(event_details))
+        self.adapter.event_log.info("Chat: " + str(event_details))
         if event_details.get("from") is None and "has joined the group" in msg:
             time.sleep(1)
             self.adapter.send_chat_msg("Welcome!\nDrag yourself into Red & click 'Join Game'")
         elif "message" in event_details:
             sender = event_details["from"]
+            if msg.split()[:1] and msg.split()[0] in CHAT_COMMANDS:
+                self.adapter.command_received = self.adapter.frame_received
 
             if event_details.get("auth") and sender in self.restricted_names:
                 if msg.strip().startswith("LAUNCHNEW"):
@@ -445,7 +669,7 @@ class TagproBot:
 
             if msg.strip() == "HELP":
                 self.adapter.send_chat_msg(
-                    "Commands: HELP, SETTINGS, MAP, INFO <query>, LAUNCHNEW <preset> (<map_id>), "
+                    "Commands: HELP, SETTINGS, MAP (<name>), INFO <query>, LAUNCHNEW <preset> (<map_id>) / <name>, "
                     "REGION east/central/west/eu/oce"
                 )
             elif msg.startswith("LAUNCHNEW POOP"):
@@ -453,11 +677,30 @@ class TagproBot:
                     self.adapter.send_ws_message(["kick", self.authed_members[event_details["from"]]])
             elif msg.startswith("LAUNCHNEW"):
                 preset = None
-                if len(msg.split()) == 2:
-                    preset = msg.split()[-1]
-                elif len(msg.split()) == 3 and default_float(msg.split()[2]):
-                    preset = inject_map_id_into_preset(msg.split()[1], msg.split()[2])
-                if preset and preset.startswith("gZ"):
+                args = msg.split()[1:]
+                if args and args[0].startswith("gZ"):
+                    if len(args) == 1:
+                        preset = args[0]
+                    elif len(args) == 2 and args[1].isdigit() and int(args[1]) > 0:
+                        try:
+                            preset = inject_map_id_into_preset(args[0], args[1])
+                        except ValueError as e:  # PresetError
+                            self.adapter.send_chat_msg(f"Invalid preset: {e}")
+                    else:
+                        self.adapter.send_chat_msg("Usage: LAUNCHNEW <preset> (<map_id>)")
+                elif args:
+                    search = get_map_search(get_catalog())
+                    found, score = search.find(msg.split(" ", 1)[1])
+                    if found is None:
+                        self.adapter.send_chat_msg("No map found with that name")
+                    elif score < search.launch_score:
+                        self.adapter.send_chat_msg(f"Did you mean '{found['name']}'? Use its full name to launch it")
+                    else:
+                        preset = found["preset"]
+                        self.adapter.send_chat_msg(f"Found '{found['name']}'")
+                if preset and preset_error(preset) is not None:
+                    self.adapter.send_chat_msg(f"Invalid preset: {preset_error(preset)}")
+                elif preset:
                     self.adapter.send_chat_msg("Ending current game...")
                     time.sleep(2)
                     self.adapter.send_ws_message(["endGame"])
@@ -470,12 +713,19 @@ class TagproBot:
                 self.load_random_preset()
             elif msg == "MAP":
                 self.adapter.send_chat_msg(self.game_str)
+            elif msg.startswith("MAP "):
+                found, _ = get_map_search(get_catalog()).find(msg.split(" ", 1)[1])
+                if found is None:
+                    self.adapter.send_chat_msg("No map found with that name")
+                else:
+                    self.adapter.send_chat_msg(self.info_card(found["preset"]))
             elif msg.startswith("INFO"):
                 if len(msg.strip().split()) > 1:
                     query = msg.strip().split(" ", 1)[1]
-                    random.shuffle(PERIODIC_MESSAGES)
-                    best_info_str = max(PERIODIC_MESSAGES, key=lambda s: fuzz.partial_ratio(query.lower(), s.lower()))
-                    self.adapter.send_chat_msg(best_info_str)
+                    best_info_index = process.extractOne(
+                        query.lower(), PERIODIC_MESSAGES_LOWER, scorer=fuzz.partial_ratio, processor=None
+                    )[2]
+                    self.adapter.send_chat_msg(PERIODIC_MESSAGES[best_info_index])
                 else:
                     self.adapter.send_chat_msg(random.choice(PERIODIC_MESSAGES))
             elif msg == "MODERATE":
@@ -517,7 +767,7 @@ class TagproBot:
             new_settings = dict(self.settings)
             new_settings[key] = value
             try:
-                legal_maps = self.get_legal_maps(get_maps(), new_settings)
+                legal_maps = self.get_legal_maps(new_settings)
             except Exception as e:
                 print("FAILED LEGAL MAPS", e)
                 legal_maps = None
@@ -534,60 +784,88 @@ class TagproBot:
         self.current_game_preset = self.current_preset
         self.current_preset = None
         self.adapter.send_ws_message(["groupPlay"])
-        event_logger.info(f"Launched preset: {self.current_game_preset}")
+        self.adapter.event_log.info(f"Launched preset: {self.current_game_preset}")
         time.sleep(5)
         return True
 
-    def get_legal_maps(self, maps, settings):
-        if settings["category"]:
-            maps = [m for m in maps if settings["category"].lower() in m["category"].lower()]
-        if settings["difficulty"]:
-            low, high = float(settings["difficulty"][0] or 0.0), float(settings["difficulty"][1] or 100.0)
-            maps = [m for m in maps if low <= default_float(m["difficulty"], 10) <= high]
-        minfun = default_float(settings["minfun"], 0.0)
-        maps = [m for m in maps if default_float(m["fun"], 100) >= minfun]
-        maps = [m for m in maps if any(str(br) in m["balls_req"] for br in range((self.num_ready_balls or 1) + 1))]
-        return maps
+    def get_legal_maps(self, settings):
+        return get_catalog().selector.select(settings, self.num_ready_balls or 1)
 
     def load_random_preset(self):
-        maps = self.get_legal_maps(get_maps(), self.settings)
+        maps = self.get_legal_maps(self.settings)
         if not maps:
             self.settings = dict(self.default_map_settings)
-            maps = self.get_legal_maps(get_maps(), self.settings)
+            maps = self.get_legal_maps(self.settings)
         self.load_preset(random.choice([m["preset"] for m in maps]))
 
     def load_preset(self, preset):
+        error = preset_error(preset)
+        if error is not None:  # never hand the group a preset it can't apply
+            self.adapter.event_log.error(f"Not applying preset: {error}")
+            return
         self.adapter.send_ws_message(["groupPresetApply", preset])
         self.current_preset = preset
-        event_logger.info(f"Set preset: {preset}")
-
-    def run(self):
-        i = 1
-        launched_new = False
-        while True:
-            time.sleep(1)
-
-            self.ensure_in_group(self.room_name)
-            self.adapter.process_ws_events()
-
-            if launched_new:
+        self.adapter.event_log.info(f"Set preset: {preset}")
+        self.info_card(preset)  # warm the card for the post-launch announcement
+
+    def start(self):
+        now = time.monotonic()
+        self.launched_new = False
+        self.next_group_check = now
+        self.next_preset_check = now + 10
+        self.next_periodic_msg = now + 1800
+        self.next_roster_check = now + 30
+
+    def step(self):
+        """one pass of the main loop; blocks for at most about a second waiting on websocket frames"""
+        with metrics.timer("tick"):
+            self._step()
+
+    def _step(self):
+        if time.monotonic() >= self.next_group_check:
+            with metrics.timer("phase.ensure_in_group"):
+                self.ensure_in_group(self.room_name)
+            self.next_group_check = time.monotonic() + 1
+        # returns as soon as frames arrive, otherwise at the next group check
+        with metrics.timer("phase.process_ws_events"):
+            self.adapter.process_ws_events(timeout=max(0.0, self.next_group_check - time.monotonic()))
+        now = time.monotonic()
+
+        if self.launched_new:
+            with metrics.timer("phase.announce_game"):
                 time.sleep(5)
                 self.adapter.send_chat_msg(self.game_str)
-                launched_new = False
-
-            if i % 1800 == 0:
-                self.adapter.send_chat_msg(random.choice(PERIODIC_MESSAGES))
-
-            # ensure random preset loaded before launching
-            if i % 10 == 0 and not self.adapter.is_game_active() and self.num_in_lobby != 1:
-                self.load_random_preset()
-                time.sleep(2)
-                launched_new = self.maybe_launch()
+            self.launched_new = False
+
+        if now >= self.next_roster_check and self.adapter.current_url().startswith(self.URL):
+            with metrics.timer("phase.check_lobby_players"):
+                self.check_lobby_players()
+            self.next_roster_check = now + 30
+
+        if now >= self.next_periodic_msg:
+            self.adapter.send_chat_msg(random.choice(PERIODIC_MESSAGES))
+            self.next_periodic_msg += 1800
+
+        # ensure random preset loaded before launching
+        if now >= self.next_preset_check:
+            self.next_preset_check = now + 10
+            with metrics.timer("phase.preset"):
+                if not self.adapter.is_game_active() and self.num_in_lobby != 1:
+                    with metrics.timer("phase.load_random_preset"):
+                        self.load_random_preset()
+                    time.sleep(2)
+                    with metrics.timer("phase.maybe_launch"):
+                        self.launched_new = self.maybe_launch()
 
-            i += 1
+        metrics.maybe_flush()
 
+    def run(self):
+        self.start()
+        while True:
+            self.step()
 
 if __name__ == '__main__':
+    start_catalog_refresher()
     adapter = DriverAdapter()
     bot = TagproBot(adapter)
     bot.run()
@@ -0,0 +1,51 @@
+import functools
+import random
+
+from rapidfuzz import fuzz, process, utils
+
+
+def split_author(name):
+    """'Map by Author' -> ('Map', 'Author'); names without an author give ('Map', '')"""
+    if " by " in name:
+        name, author = name.rsplit(" by ", 1)
+        return name.strip(), author.strip()
+    return name.strip(), ""
+
+
+class MapSearch:
+    """Fuzzy lookup of catalog maps for chat commands: names first, then exact-ish authors and categories"""
+
+    min_score = 85
+    launch_score = 95  # below this a match is only suggested, not launched
+
+    def __init__(self, maps):
+        self.names = self._index((split_author(m["name"])[0], m) for m in maps)
+        self.others = self._index(
+            (text, m) for m in maps for text in (split_author(m["name"])[1], m["category"])
+        )
+
+    @staticmethod
+    def _index(pairs):
+        maps_by_choice = {}
+        for text, m in pairs:
+            choice = utils.default_process(text)
+            if choice:
+                maps_by_choice.setdefault(choice, []).append(m)
+        return list(maps_by_choice), list(maps_by_choice.values())
+
+    def find(self, query):
+        """(map entry, score) of the best match at or above min_score, else (None, 0)"""
+        query = utils.default_process(query)
+        # authors and categories are short, so partial scorers would match them inside unrelated queries
+        for (choices, maps), scorer in ((self.names, fuzz.WRatio), (self.others, fuzz.ratio)):
+            match = process.extractOne(query, choices, scorer=scorer, processor=None, score_cutoff=self.min_score)
+            if match is not None:
+                # authors and categories match several maps; one is picked at random
+                return random.choice(maps[match[2]]), match[1]
+        return None, 0
+
+
+@functools.lru_cache(maxsize=2)
+def get_map_search(catalog):
+    """search index for a catalog; a refreshed catalog is a new object and gets a new index"""
+    return MapSearch(catalog.maps)
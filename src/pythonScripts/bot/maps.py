@@ -1,43 +1,146 @@
-import requests
 import time
 import functools
 import io
 import csv
+import hashlib
+import json
+import math
+import os
+import random
+import threading
+from bisect import bisect_left, bisect_right
+from typing import NamedTuple
+
+import http_client
+from preset_codec import parse_preset, validate_presets
+from stats_store import write_json_atomic, write_text_atomic
 
 
 def inject_map_id_into_preset(preset, map_id):
-    digits = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
-    n = int(map_id)
-    enc = digits[0] if n == 0 else ""
-    while n:
-        n, r = divmod(n, 52)
-        enc = digits[r] + enc
-    inner = "f" + enc
-    inj = "M" + digits[len(inner)] + inner
-    pos = preset.find("M")
-    if pos == -1:
-        return preset
-    old_len = digits.index(preset[pos + 1])
-    return preset[:pos] + inj + preset[pos + 2 + old_len:]
-
-
-def lru_cache_6hrs(func):
-    cached = functools.lru_cache(maxsize=128)(lambda *args, _p, **kwargs: func(*args, **kwargs))
-    return lambda *args, **kwargs: cached(*args, _p=int(time.time() // 21600), **kwargs)
-
-
-@lru_cache_6hrs
-def get_maps():
-    response = requests.get(
-        "https://docs.google.com/spreadsheets/d/1OnuTCekHKCD91W39jXBG4uveTCCyMxf9Ofead43MMCU/export",
-        params={
-            "format": "csv",
-            'id': '1OnuTCekHKCD91W39jXBG4uveTCCyMxf9Ofead43MMCU',
-            'gid': '1775606307',
-        }
-    )
-    csv_file = io.StringIO(response.text, newline="")
-    map_data = [
+    """preset with its map id replaced; raises PresetError for a malformed preset"""
+    return parse_preset(preset).with_map_id(map_id).encode()
+
+
+def default_float(s, default=None):
+    try:
+        return float(s)
+    except ValueError:
+        return default
+
+
+SHEET_URL = "https://docs.google.com/spreadsheets/d/1OnuTCekHKCD91W39jXBG4uveTCCyMxf9Ofead43MMCU/export"
+SHEET_PARAMS = {
+    "format": "csv",
+    'id': '1OnuTCekHKCD91W39jXBG4uveTCCyMxf9Ofead43MMCU',
+    'gid': '1775606307',
+}
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache")
+
+
+class SheetCache:
+    """the map sheet CSV cached on disk and revalidated once older than max_age"""
+
+    def __init__(self, path, url, params, max_age=21600, background=False):
+        self.path = path
+        self.url = url
+        self.params = params
+        self.max_age = max_age
+        self.background = background
+        self.lock = threading.Lock()
+        self.refreshing = False
+        self.loaded = (None, None)  # (file mtimes, (text, meta)), so unchanged files aren't read again
+
+    def load(self):
+        try:
+            mtimes = (os.stat(self.path).st_mtime_ns, os.stat(self.path + ".meta").st_mtime_ns)
+            if self.loaded[0] == mtimes:
+                return self.loaded[1]
+            with open(self.path, encoding="utf-8", newline="") as f:
+                text = f.read()
+            with open(self.path + ".meta") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        self.loaded = (mtimes, (text, meta))
+        return text, meta
+
+    def save(self, text, meta):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        write_text_atomic(self.path, text)
+        write_json_atomic(self.path + ".meta", meta)
+
+    def fetch(self):
+        """download (or revalidate) the sheet and return its text; raises if it can't be had"""
+        cached = self.load()
+        headers = {}
+        if cached is not None:
+            if cached[1].get("etag"):
+                headers["If-None-Match"] = cached[1]["etag"]
+            if cached[1].get("last_modified"):
+                headers["If-Modified-Since"] = cached[1]["last_modified"]
+        response = http_client.get(self.url, params=self.params, headers=headers)
+        if response.status_code == 304 and cached is not None:
+            text, meta = cached
+        else:
+            response.raise_for_status()
+            text = response.text
+            if "Group Preset" not in next(csv.reader(io.StringIO(text, newline="")), []):  # an error page, not the sheet
+                raise ValueError("map sheet export has no 'Group Preset' column")
+            meta = {"etag": response.headers.get("ETag"), "last_modified": response.headers.get("Last-Modified")}
+        meta["fetched_at"] = time.time()
+        self.save(text, meta)
+        return text
+
+    def get(self):
+        cached = self.load()
+        if cached is None:
+            return self.fetch()
+        text, meta = cached
+        if time.time() - meta.get("fetched_at", 0) > self.max_age:
+            if not self.background:
+                return self.get_fresh()
+            self.refresh_in_background()
+        return text
+
+    def get_fresh(self):
+        """revalidated text, or the cached copy if the sheet can't be reached"""
+        try:
+            return self.fetch()
+        except Exception as e:
+            cached = self.load()
+            if cached is None:
+                raise
+            print("map sheet unreachable, using cached copy:", e)
+            return cached[0]
+
+    def refresh_in_background(self):
+        with self.lock:
+            if self.refreshing:
+                return
+            self.refreshing = True
+        threading.Thread(target=self._refresh, daemon=True).start()
+
+    def _refresh(self):
+        try:
+            self.fetch()
+        except Exception as e:
+            print("map sheet refresh failed, using cached copy:", e)
+        finally:
+            with self.lock:
+                self.refreshing = False
+
+
+sheet_cache = SheetCache(os.path.join(CACHE_DIR, "map_sheet.csv"), SHEET_URL, SHEET_PARAMS)
+
+
+CATALOG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "catalog.json")
+CATALOG_VERSION = 2
+
+
+def parse_rows(text):
+    """every sheet row, in sheet order"""
+    csv_file = io.StringIO(text, newline="")
+    return [
         {
             "name": conf["Map / Player"],
             "preset": conf["Group Preset"],
@@ -52,13 +155,236 @@ def get_maps():
             "max_balls_rec": conf["Max\nBalls\nRec"]
         }
         for conf in csv.DictReader(csv_file)
-        if conf["Group Preset"].strip()
-    ]
-    illegal_maps = [
-        m for m in map_data if
-        not m["preset"].strip() or
-        not m["map_id"] or
-        inject_map_id_into_preset(m["preset"], m["map_id"]) != m["preset"]
     ]
+
+
+def parse_maps(rows):
+    """the rows with a preset, before validation"""
+    return [m for m in rows if m["preset"].strip()]
+
+
+def validate_maps(map_data):
+    """(legal maps, illegal maps); a map id used by any illegal row is dropped everywhere"""
+    preset_errors = validate_presets(m["preset"] for m in map_data)
+    illegal_maps = []
+    for m in map_data:
+        if preset_errors[m["preset"]] is not None:
+            illegal_maps.append(m)
+            continue
+        try:
+            # the preset must already carry the row's map id
+            if parse_preset(m["preset"]).map_id != int(m["map_id"]):
+                illegal_maps.append(m)
+        except ValueError:  # missing or non-numeric map id
+            illegal_maps.append(m)
+    illegal_ids = {m["map_id"] for m in illegal_maps}
+    return [m for m in map_data if m["map_id"] not in illegal_ids], illegal_maps
+
+
+def sha256_of(text):
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def compile_catalog(text):
+    """validated maps and rejected rows for a sheet export, with content and source hashes"""
+    rows = parse_rows(text)
+    maps, illegal_maps = validate_maps(parse_maps(rows))
     print("illegal maps:", illegal_maps)
-    return [m for m in map_data if m["map_id"] not in [im["map_id"] for im in illegal_maps]]
+    # the website's map_metadata.json takes every row, preset or not, so the rows are kept as well
+    metadata_rows = [{key: m[key] for key in ("name", "difficulty", "balls_req", "preset")} for m in rows]
+    content = {"maps": maps, "illegal": illegal_maps, "rows": metadata_rows}
+    return {
+        "version": CATALOG_VERSION,
+        "hash": sha256_of(json.dumps(content, sort_keys=True)),
+        "source_hash": sha256_of(text),
+        **content,
+    }
+
+
+def load_catalog_artifact(path=CATALOG_PATH):
+    try:
+        with open(path) as f:
+            artifact = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return artifact if artifact.get("version") == CATALOG_VERSION else None
+
+
+def get_catalog_artifact(text, path=CATALOG_PATH):
+    """the artifact for this sheet export, read from path when it was built from the same export"""
+    artifact = load_catalog_artifact(path)
+    if artifact is not None and artifact["source_hash"] == sha256_of(text):
+        return artifact
+    compiled = compile_catalog(text)
+    write_json_atomic(path, compiled)
+    return compiled
+
+
+class MapCatalog:
+    """Spreadsheet maps indexed by map id, pseudo map id, preset and name."""
+
+    def __init__(self, maps):
+        self.maps = maps
+        self.by_map_id = {}
+        self.by_pseudo_id = {}
+        self.by_preset = {}
+        self.by_name = {}
+        for m in maps:
+            if m["map_id"] in self.by_map_id:
+                print("duplicate map id:", m["map_id"])
+            self.by_map_id.setdefault(m["map_id"], m)
+            for pseudo_id in m["equivalent_map_ids"]:
+                if pseudo_id.strip():
+                    self.by_pseudo_id.setdefault(pseudo_id.strip(), m)
+            self.by_preset.setdefault(m["preset"], m)
+            self.by_name.setdefault(m["name"], m)
+
+    def __len__(self):
+        return len(self.maps)
+
+    def __iter__(self):
+        return iter(self.maps)
+
+    def lookup(self, map_id):
+        """canonical entry for a played map id, falling back to pseudo map ids"""
+        return self.by_map_id.get(map_id) or self.by_pseudo_id.get(str(map_id))
+
+    @functools.cached_property
+    def selector(self):
+        return MapSelector(self.maps)
+
+
+class MapRecord(NamedTuple):
+    index: int
+    difficulty: float
+    fun: float
+    category: str
+    min_balls: float  # fewest ready balls the map is allowed with, inf if balls_req names none
+    entry: dict
+
+
+def min_balls_allowed(balls_req):
+    # a ball count br is allowed when str(br) appears in balls_req; the smallest such count is always a
+    # single digit, since any longer number containing a digit is bigger than that digit
+    return min((int(c) for c in balls_req if c in "0123456789"), default=float("inf"))
+
+
+class MapSelector:
+    """legal map filtering over sorted difficulty, fun and ball indexes"""
+
+    max_cached = 256
+
+    def __init__(self, maps):
+        self.records = [
+            MapRecord(
+                index=i,
+                difficulty=default_float(m["difficulty"], 10),
+                fun=default_float(m["fun"], 100),
+                category=m["category"].lower(),
+                min_balls=min_balls_allowed(m["balls_req"]),
+                entry=m,
+            )
+            for i, m in enumerate(maps)
+        ]
+        self.difficulty_index = self._sorted_index("difficulty")
+        self.fun_index = self._sorted_index("fun")
+        self.balls_index = self._sorted_index("min_balls")
+        self.by_category = {}
+        for r in self.records:
+            self.by_category.setdefault(r.category, set()).add(r.index)
+        self.cache = {}
+
+    def _sorted_index(self, field):
+        # NaN fails every comparison in the old filters too, so it is left out of the index
+        ordered = sorted((r for r in self.records if not math.isnan(getattr(r, field))), key=lambda r: getattr(r, field))
+        return [getattr(r, field) for r in ordered], [r.index for r in ordered]
+
+    @staticmethod
+    def _between(index, low, high):
+        keys, ids = index
+        return set(ids[bisect_left(keys, low):bisect_right(keys, high)])
+
+    def select(self, settings, num_balls):
+        """map entries legal under settings with num_balls ready balls, in catalog order"""
+        key = (
+            settings["category"],
+            tuple(settings["difficulty"]) if isinstance(settings["difficulty"], list) else settings["difficulty"],
+            settings["minfun"],
+            num_balls,
+        )
+        # bots hosted in one process share the selector, so the cache is only read once per call
+        selected = self.cache.get(key)
+        if selected is None:
+            selected = self._select(settings, num_balls)
+            if len(self.cache) >= self.max_cached:
+                self.cache.clear()
+            self.cache[key] = selected
+        return list(selected)
+
+    def _select(self, settings, num_balls):
+        ids = self._between(self.balls_index, 0, num_balls)
+        if settings["category"]:
+            query = settings["category"].lower()
+            ids &= set().union(*(bucket for category, bucket in self.by_category.items() if query in category))
+        if settings["difficulty"]:
+            low, high = float(settings["difficulty"][0] or 0.0), float(settings["difficulty"][1] or 100.0)
+            ids &= self._between(self.difficulty_index, low, high)
+        ids &= self._between(self.fun_index, default_float(settings["minfun"], 0.0), float("inf"))
+        return tuple(self.records[i].entry for i in sorted(ids))
+
+
+@functools.lru_cache(maxsize=2)
+def _catalog_for(text):
+    return MapCatalog(get_catalog_artifact(text)["maps"])
+
+
+def _load_catalog():
+    # keyed on the sheet text, so a revalidated sheet is picked up on the next call
+    return _catalog_for(sheet_cache.get())
+
+
+class CatalogRefresher:
+    """replaces .catalog with a freshly built MapCatalog every interval (+/- jitter) seconds"""
+
+    def __init__(self, interval=21600, jitter=0.1):
+        self.interval = interval
+        self.jitter = jitter
+        self.catalog = _load_catalog()
+        self.text = None
+        self.thread = threading.Thread(target=self._run, daemon=True, name="catalog-refresher")
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval * random.uniform(1 - self.jitter, 1 + self.jitter))
+            try:
+                self.refresh()
+            except Exception as e:
+                print("catalog refresh failed, keeping current catalog:", e)
+
+    def refresh(self):
+        text = sheet_cache.get_fresh()
+        if text == self.text:
+            return
+        catalog = MapCatalog(get_catalog_artifact(text)["maps"])
+        catalog.selector  # build now, off the bot's thread
+        self.text = text
+        self.catalog = catalog
+
+
+_refresher = None
+
+
+def start_catalog_refresher(interval=21600, jitter=0.1):
+    """from here on get_catalog returns the refresher's snapshot and never does I/O"""
+    global _refresher
+    if _refresher is None:
+        refresher = CatalogRefresher(interval, jitter)
+        refresher.thread.start()
+        _refresher = refresher
+    return _refresher
+
+
+def get_catalog():
+    if _refresher is not None:
+        return _refresher.catalog
+    return _load_catalog()
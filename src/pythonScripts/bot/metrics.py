@@ -0,0 +1,97 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from stats_store import write_json_atomic
+
+# histogram bucket upper bounds in milliseconds; the last bucket takes everything slower
+BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000)
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS_MS) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, ms):
+        self.counts[bisect_left(BUCKETS_MS, ms)] += 1
+        self.count += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+    def quantile(self, q):
+        """upper bound of the bucket holding the q-th quantile"""
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(BUCKETS_MS, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return self.max_ms
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean_ms": round(self.total_ms / self.count, 1) if self.count else 0.0,
+            "p50_ms": self.quantile(0.5),
+            "p90_ms": self.quantile(0.9),
+            "p99_ms": self.quantile(0.99),
+            "max_ms": round(self.max_ms, 1),
+            "buckets": dict(zip([f"<={b}" for b in BUCKETS_MS] + ["slower"], self.counts)),
+        }
+
+
+class Metrics:
+    """timing histograms and counters shared by every bot in the process"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.started = time.time()
+        self.next_flush = time.monotonic() + 60
+
+    def observe(self, name, ms):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].observe(ms)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, (time.perf_counter() - start) * 1000)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "since": self.started,
+                "at": time.time(),
+                "counters": dict(sorted(self.counters.items())),
+                "timings": {name: h.summary() for name, h in sorted(self.histograms.items())},
+            }
+
+    def flush(self, path="metrics.json"):
+        write_json_atomic(path, self.snapshot())
+
+    def maybe_flush(self, interval=60):
+        """flush if interval has passed since the last flush; bots sharing the process call this every step"""
+        with self.lock:
+            now = time.monotonic()
+            if now < self.next_flush:
+                return
+            self.next_flush = now + interval
+        self.flush()
+
+
+metrics = Metrics()
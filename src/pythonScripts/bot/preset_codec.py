@@ -0,0 +1,73 @@
+import functools
+from dataclasses import dataclass, replace
+
+# preset layout: "gZ" "M" <length> "f" <map id> <other settings, kept verbatim>, numbers in base 52 over DIGITS
+DIGITS = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+PREFIX = "gZ"
+MAP_FIELD = "M"
+MAP_KIND = "f"
+
+
+class PresetError(ValueError):
+    pass
+
+
+def encode_base52(n):
+    enc = DIGITS[0] if n == 0 else ""
+    while n:
+        n, r = divmod(n, 52)
+        enc = DIGITS[r] + enc
+    return enc
+
+
+def decode_base52(s):
+    n = 0
+    for c in s:
+        n = n * 52 + DIGITS.index(c)
+    return n
+
+
+@dataclass(frozen=True)
+class GroupPreset:
+    map_id: int
+    settings: str  # everything after the map field, verbatim
+
+    def encode(self):
+        value = MAP_KIND + encode_base52(self.map_id)
+        if len(value) >= len(DIGITS):
+            raise PresetError(f"map id {self.map_id} is too large for a preset")
+        return PREFIX + MAP_FIELD + DIGITS[len(value)] + value + self.settings
+
+    def with_map_id(self, map_id):
+        return replace(self, map_id=int(map_id))
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_preset(preset):
+    """GroupPreset for a preset string; raises PresetError unless it encodes back to exactly the same string"""
+    if not preset.startswith(PREFIX + MAP_FIELD) or len(preset) < 4:
+        raise PresetError(f"preset must start with {PREFIX + MAP_FIELD!r}: {preset!r}")
+    if any(c not in DIGITS for c in preset):
+        raise PresetError(f"preset has characters outside a-zA-Z: {preset!r}")
+    length = DIGITS.index(preset[3])
+    value = preset[4:4 + length]
+    if len(value) != length or len(value) < 2 or value[0] != MAP_KIND:
+        raise PresetError(f"malformed map field in preset {preset!r}")
+    parsed = GroupPreset(decode_base52(value[1:]), preset[4 + length:])
+    if parsed.encode() != preset:
+        raise PresetError(f"map id in preset {preset!r} is not canonically encoded")
+    return parsed
+
+
+def preset_error(preset):
+    """None if preset is valid, else why not"""
+    try:
+        parse_preset(preset)
+    except PresetError as e:
+        return str(e)
+    return None
+
+
+def validate_presets(presets):
+    """{preset: None or error message} for every distinct preset; parses are memoised across calls"""
+    return {preset: preset_error(preset) for preset in dict.fromkeys(presets)}
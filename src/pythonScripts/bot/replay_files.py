@@ -0,0 +1,104 @@
+import argparse
+import json
+import os
+import zipfile
+
+# a stored replay is a zip of one JSON array per packet type plus order.json, the packet types in order
+REPLAY_SUFFIX = ".zip"
+
+
+def packet_type_of(line):
+    """packet type of a raw `[ts,"type",data]` replay line, without decoding the data"""
+    start = line.find(b",") + 1
+    return json.loads(line[start:line.find(b",", start)])
+
+
+def iter_packets(lines, packet_types=None):
+    for line in lines:
+        if line.strip() and (packet_types is None or packet_type_of(line) in packet_types):
+            yield json.loads(line)
+
+
+def list_replays(replay_dir):
+    """uuids of every replay in replay_dir, compact or legacy JSON array"""
+    uuids = set()
+    for entry in os.scandir(replay_dir):
+        if not entry.is_file() or entry.name.endswith(".tmp"):
+            continue
+        uuids.add(entry.name[:-len(REPLAY_SUFFIX)] if entry.name.endswith(REPLAY_SUFFIX) else entry.name)
+    return uuids
+
+
+def write_replay(replay_dir, uuid, lines):
+    """store raw replay lines, via a temp file so a partial download never looks complete"""
+    type_ids, order, members = {}, [], {}
+    for line in lines:
+        packet_type = packet_type_of(line)
+        if packet_type not in members:
+            type_ids[packet_type] = len(type_ids)
+            members[packet_type] = []
+        members[packet_type].append(line.strip())
+        order.append(type_ids[packet_type])
+
+    path = os.path.join(replay_dir, uuid + REPLAY_SUFFIX)
+    with zipfile.ZipFile(path + ".tmp", "w", zipfile.ZIP_DEFLATED, compresslevel=6) as z:
+        z.writestr("order.json", json.dumps({"types": list(type_ids), "order": order}, separators=(",", ":")))
+        for packet_type, member_lines in members.items():
+            z.writestr(f"{packet_type}.json", b"[" + b",".join(member_lines) + b"]")
+    os.replace(path + ".tmp", path)
+
+
+def read_replay(replay_dir, uuid, packet_types=None):
+    """yield the packets of a stored replay in original order, decoding only packet_types (all if None)"""
+    path = os.path.join(replay_dir, uuid + REPLAY_SUFFIX)
+    if not os.path.exists(path):
+        # legacy uncompressed JSON array
+        with open(os.path.join(replay_dir, uuid)) as f:
+            replay = json.load(f)
+        yield from (packet for packet in replay if packet_types is None or packet[1] in packet_types)
+        return
+
+    with zipfile.ZipFile(path) as z:
+        layout = json.loads(z.read("order.json"))
+        members = [
+            iter(json.loads(z.read(f"{packet_type}.json")))
+            if packet_types is None or packet_type in packet_types else None
+            for packet_type in layout["types"]
+        ]
+    for i in layout["order"]:
+        if members[i] is not None:
+            yield next(members[i])
+
+
+def migrate(replay_dir):
+    """rewrite legacy JSON array replays in replay_dir into the compact format"""
+    before = after = migrated = 0
+    for entry in os.scandir(replay_dir):
+        if not entry.is_file() or entry.name.endswith(REPLAY_SUFFIX) or entry.name.endswith(".tmp"):
+            continue
+        with open(entry.path) as f:
+            replay = json.load(f)
+        write_replay(replay_dir, entry.name, [json.dumps(packet, separators=(",", ":")).encode() for packet in replay])
+        before += entry.stat().st_size
+        after += os.path.getsize(entry.path + REPLAY_SUFFIX)
+        os.remove(entry.path)
+        migrated += 1
+    print(f"Migrated {migrated} replays: {before / 1e6:.1f} MB -> {after / 1e6:.1f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay storage tools")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    # Subcommand: migrate
+    migrate_parser = subparsers.add_parser("migrate", help="Convert legacy JSON array replays to the compact format")
+    migrate_parser.add_argument("replay_dir", nargs="?", default="./replays", help="Replay directory")
+
+    args = parser.parse_args()
+
+    if args.command == "migrate":
+        migrate(args.replay_dir)
+
+
+if __name__ == "__main__":
+    main()
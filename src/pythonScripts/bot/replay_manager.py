@@ -1,28 +1,39 @@
 import time
 import requests
 import json
-import os
+import itertools
+import argparse
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
 
-from maps import get_maps
+from maps import get_catalog, sheet_cache
+from replay_files import iter_packets, list_replays, read_replay
+from stats_store import get_stats_store, get_wr_index, write_json_atomic
+from downloader import ReplayDownloader
+import http_client
 
 
-def process_replays():
-    get_maps()
+replay_downloader = ReplayDownloader("./replays")
+
+
+def process_replays(workers=1):
+    sheet_cache.background = True  # long-running: serve the cached sheet while it revalidates
+    get_catalog()
     while True:
         try:
-            update_replays()
+            update_replays(workers)
         except (RuntimeError, json.decoder.JSONDecodeError) as e:
             print(e)
             time.sleep(120)
 
 
-def update_replays():
+def update_replays(workers=1):
     is_updated = process_downloaded_replays(
         replay_stats_path="replay_stats.json",
-        replay_download_dir="./replays"
+        replay_download_dir="./replays",
+        workers=workers
     )
     if is_updated:
-        push_replay_stats_to_leaderboard(replay_stats_path="replay_stats.json")
+        push_replay_stats_to_leaderboard()
 
     # download bot replays (if not already downloaded)
     bot_logged_replays = [line.strip() for line in open("replay_uuids.txt").readlines() if line.strip()]
@@ -35,11 +46,12 @@ def update_replays():
 
 
 def download_replays(uuids):
-    downloaded = {f.name for f in os.scandir("./replays") if f.is_file()}
+    downloaded = list_replays("./replays")
     try:
         attempts = json.load(open("download_attempts.json"))
     except FileNotFoundError:
         attempts = {}
+    due = []
     for uid in set(uuids) - downloaded:
         now = time.time()
         if uid not in attempts:
@@ -49,50 +61,101 @@ def download_replays(uuids):
             if last - first > 86400 or now - last <= (last - first) / 4:
                 continue
             attempts[uid]["last"] = now
-        r = get_replay_data(uid)
-        if r:
-            print("success for", uid)
-            json.dump(r, open(f"./replays/{uid}", "w"))
-        else:
-            print("failure for", uid)
-    json.dump(attempts, open("download_attempts.json", "w"))
+        due.append(uid)
+    for uid, saved in replay_downloader.download(due).items():
+        print("success for" if saved else "failure for", uid)
+    if due:
+        print("HTTP latency:", http_client.latency_stats())
+    write_json_atomic("download_attempts.json", attempts)
+
+
+def process_downloaded_replays(replay_stats_path, replay_download_dir, workers=1):
+    store = get_stats_store()
+    catalog = get_catalog()
+
+    # process unprocessed replays, and processed ones whose catalog row changed since
+    downloaded_replays = list_replays(replay_download_dir)
+    unprocessed_downloaded_replay_uuids = sorted(downloaded_replays - store.uuids())
+    stale_replays = find_stale_replays(store, catalog)
+    if stale_replays:
+        print(f"Re-processing {len(stale_replays)} replays of maps whose catalog rows changed")
+        missing = {}
+        for replay_uuid, deps in stale_replays.items():
+            if replay_uuid not in downloaded_replays:
+                missing.setdefault(deps, []).append(replay_uuid)
+        if missing:
+            # can't be parsed again, so mark them current rather than finding them stale every cycle
+            print(f"{sum(map(len, missing.values()))} of them are no longer downloaded and keep their old stats")
+            for deps, uuids in missing.items():
+                store.set_catalog_deps(uuids, deps)
+    replay_uuids = unprocessed_downloaded_replay_uuids + sorted(stale_replays.keys() & downloaded_replays)
+    if workers > 1 and len(replay_uuids) > workers:
+        new_replay_stats = parse_replays_parallel(replay_uuids, replay_download_dir, workers, catalog)
+    else:
+        new_replay_stats = {}
+        for replay_uuid in replay_uuids:
+            new_replay_stats[replay_uuid] = get_details(
+                read_replay(replay_download_dir, replay_uuid, DETAILS_PACKET_TYPES), catalog
+            )
 
+    is_updated = bool(new_replay_stats)
+    if is_updated:
+        store.add(
+            (new_replay_stats[uuid] for uuid in sorted(new_replay_stats)),
+            {uuid: catalog_fingerprint(catalog, e["actual_map_id"]) for uuid, e in new_replay_stats.items()}
+        )
+        store.export_json(replay_stats_path)  # kept for the website
+    return is_updated
 
-def process_downloaded_replays(replay_stats_path, replay_download_dir):
-    if os.path.exists(replay_stats_path):
-        replay_stats = json.load(open(replay_stats_path))  # processed replays
-    else:
-        replay_stats = {}
 
-    # process unprocessed replays
-    downloaded_replays = [entry.name for entry in os.scandir(replay_download_dir) if entry.is_file()]
-    unprocessed_downloaded_replay_uuids = set(downloaded_replays) - set(replay_stats.keys())
-    new_replay_stats = {}
-    for replay_uuid in unprocessed_downloaded_replay_uuids:
-        new_replay_stats[replay_uuid] = get_details(json.load(open(f"{replay_download_dir}/{replay_uuid}")))
+_worker_catalog = None
+_worker_replay_dir = None
 
-    replay_stats.update(new_replay_stats)
-    json.dump(replay_stats, open(replay_stats_path, "w"))
 
-    is_updated = bool(new_replay_stats)
-    return is_updated
+def _init_parse_worker(catalog, replay_download_dir):
+    global _worker_catalog, _worker_replay_dir
+    _worker_catalog, _worker_replay_dir = catalog, replay_download_dir
+
+
+def _parse_replay(replay_uuid):
+    return replay_uuid, get_details(read_replay(_worker_replay_dir, replay_uuid, DETAILS_PACKET_TYPES), _worker_catalog)
+
 
+def parse_replays_parallel(replay_uuids, replay_download_dir, workers, catalog=None, max_in_flight_per_worker=4):
+    """get_details over a process pool"""
+    results = {}
+    pending = set()
+    uuid_iter = iter(replay_uuids)
+    start = last_report = time.time()
+    with ProcessPoolExecutor(workers, initializer=_init_parse_worker, initargs=(catalog or get_catalog(), replay_download_dir)) as pool:
+        for replay_uuid in itertools.islice(uuid_iter, workers * max_in_flight_per_worker):
+            pending.add(pool.submit(_parse_replay, replay_uuid))
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                replay_uuid, details = future.result()
+                results[replay_uuid] = details
+                for next_uuid in itertools.islice(uuid_iter, 1):
+                    pending.add(pool.submit(_parse_replay, next_uuid))
+            if time.time() - last_report > 5 or not pending:
+                last_report = time.time()
+                print(f"parsed {len(results)}/{len(replay_uuids)} replays ({len(results) / (last_report - start):.1f}/s)")
+    return results
 
-def push_replay_stats_to_leaderboard(replay_stats_path):
-    data = json.load(open(replay_stats_path))
-    data = list(data.values())
 
-    spreadsheet_map_ids = set([m["map_id"] for m in get_maps()])
+def push_replay_stats_to_leaderboard():
+    data = get_stats_store().entries("record_time IS NOT NULL")  # filter out DNF
+
+    catalog = get_catalog()
 
     data = [
         d for d in data
-        if d["record_time"] is not None and # filter out DNF
-        d["map_id"] in spreadsheet_map_ids  # filter out maps not on spreadsheet
+        if d["map_id"] in catalog.by_map_id  # filter out maps not on spreadsheet
     ]
 
     data = sorted(data, key=lambda d: -d["timestamp"])
 
-    response = requests.post(
+    response = http_client.post(
         "https://worldrecords.bambitp.workers.dev/upload",
         params={"password": "insertPW"},
         headers={"Content-Type": "application/json"},
@@ -101,88 +164,128 @@ def push_replay_stats_to_leaderboard(replay_stats_path):
     print("Push to leaderboard status code:", response.status_code)
 
 
-def get_wr_entry(map_id, replay_stats_path="replay_stats.json"):
-    """load wr for map_id from replay_stats.json"""
-    for _ in range(10):
-        try:
-            data = json.load(open(replay_stats_path))
-        except json.decoder.JSONDecodeError:
-            time.sleep(0.1)
+def get_wr_entry(map_id):
+    """fastest finished run on map_id"""
+    return get_wr_index().get(map_id)
+
+
+def index_replay(replay, is_finishing_cap):
+    """first time packet, first timer start, last chats, mapupdate count and finishing cap, in one pass"""
+    mapupdates = 0
+    first_time = None
+    first_timer_ts = None
+    last_chat = {}
+    cap = None
+    for packet in replay:
+        ts, packet_type, data = packet
+        if packet_type == "mapupdate":
+            mapupdates += 1
             continue
-        break
+        if packet_type == "p":
+            if cap is None:
+                for cap_details in data:
+                    if is_finishing_cap(cap_details):
+                        cap = (ts, cap_details["id"])
+                        break
+        elif packet_type == "time":
+            if first_time is None:
+                first_time = packet
+            if first_timer_ts is None and data["state"] == 1:
+                first_timer_ts = ts
+        elif packet_type == "chat":
+            if "from" in data:
+                last_chat[data["from"]] = data.get("message")
+    return {
+        "first_time": first_time,
+        "mapupdates": mapupdates,
+        "first_timer_ts": first_timer_ts,
+        "last_chat": last_chat,
+        "cap": cap,
+    }
 
-    if isinstance(data, dict):
-        data_iter = data.values()
-    elif isinstance(data, list):
-        data_iter = data
+
+def catalog_terms(catalog, map_id):
+    """(effective map id, caps to win, allow blue caps): everything a replay's stats take from the catalog"""
+    # direct map id match, then equivalent (pseudo) map ids
+    spreadsheet_map = catalog.lookup(map_id)
+    if not spreadsheet_map:
+        return map_id, 1, False
+    if spreadsheet_map.get("caps_to_win") == 'pups':
+        caps_to_win = float("inf")
     else:
-        raise TypeError("Unexpected data format in replay_stats.json")
+        caps_to_win = int(spreadsheet_map.get("caps_to_win") or 1)
+    return spreadsheet_map["map_id"], caps_to_win, bool(spreadsheet_map["allow_blue_caps"])
 
-    map_entries = [entry for entry in data_iter if entry["map_id"] == map_id and entry["record_time"]]
-    if not map_entries:
-        return None
-    return min(
-        map_entries,
-        key=lambda e: e["record_time"]
-    )
 
+def catalog_fingerprint(catalog, map_id):
+    """catalog_terms as stored with each result; results whose stored value differs are stale"""
+    return json.dumps(catalog_terms(catalog, map_id))
 
-def get_details(replay):
-    assert replay[0][1] == "recorder-metadata"
-    assert replay[2][1] == "map"
-    assert replay[3][1] == "clientInfo"
-    metadata = replay[0][2]
-    map_data = replay[2][2]
+
+def find_stale_replays(store, catalog):
+    """{uuid: current catalog_fingerprint} for stats derived from catalog rows that have since changed"""
+    stale = {}
+    for actual_map_id, stored in store.catalog_dependencies():
+        current = catalog_fingerprint(catalog, actual_map_id)
+        if stored == current:
+            continue
+        if stored is not None:
+            stale.update(dict.fromkeys(store.uuids_with_catalog_deps(actual_map_id, stored), current))
+            continue
+        # parsed before terms were recorded: keep the entries that visibly agree with the current row.
+        # Entries don't record allow_blue_caps, so maps that allow them are always parsed again
+        effective_map_id, caps_to_win, allow_blue_caps = catalog_terms(catalog, actual_map_id)
+        entries = store.entries("actual_map_id IS ? AND catalog_deps IS NULL", (actual_map_id,))
+        agreeing = [] if allow_blue_caps else [
+            e["uuid"] for e in entries if e["map_id"] == effective_map_id and e["caps_to_win"] == caps_to_win
+        ]
+        store.set_catalog_deps(agreeing, current)
+        stale.update(dict.fromkeys(set(e["uuid"] for e in entries) - set(agreeing), current))
+    return stale
+
+
+def get_details(replay, catalog=None):
+    return index_details(replay, catalog)[0]
+
+
+def index_details(replay, catalog=None):
+    """(get_details result, index_replay result) for callers that time runs differently"""
+    replay = iter(replay)
+    header = list(itertools.islice(replay, 4))
+    assert header[0][1] == "recorder-metadata"
+    assert header[2][1] == "map"
+    assert header[3][1] == "clientInfo"
+    metadata = header[0][2]
+    map_data = header[2][2]
     try:
-        map_id = replay[3][2]["mapfile"].split("/")[1] if replay[3][2]["mapfile"] else None
+        map_id = header[3][2]["mapfile"].split("/")[1] if header[3][2]["mapfile"] else None
     except IndexError:
         map_id = None
 
-    spreadsheet_maps = [m for m in get_maps() if m["map_id"] == map_id]
-    assert len(spreadsheet_maps) in (0, 1)
-
-    # check equivalent maps if no matches
-    if not spreadsheet_maps:
-        spreadsheet_maps = [m for m in get_maps() if str(map_id) in m["equivalent_map_ids"]]
-
-    if spreadsheet_maps:
-        if spreadsheet_maps[0].get("caps_to_win") == 'pups':
-            caps_to_win = float("inf")
-        else:
-            caps_to_win = int(spreadsheet_maps[0].get("caps_to_win") or 1)
-        effective_map_id = spreadsheet_maps[0]["map_id"]
-        allow_blue_caps = bool(spreadsheet_maps[0]["allow_blue_caps"])
-    else:
-        caps_to_win = 1
-        effective_map_id = map_id
-        allow_blue_caps = False
-
-    first_timer_ts = [r for r in replay if r[1] == 'time' and r[2]["state"] == 1][0][0]
+    effective_map_id, caps_to_win, allow_blue_caps = catalog_terms(catalog or get_catalog(), map_id)
 
     players = {
         p["id"]: {"name": p["displayName"], "user_id": p["userId"], "is_red": p["team"] == 1}
         for p in metadata["players"]
     }
 
-    def get_run_details():
-        for cap_time, _, caps in [r for r in replay if r[1] == 'p']:
-            for cap_details in caps:
-                if cap_details.get('s-captures') != caps_to_win:
-                    continue
-                capping_player_in_game_id = cap_details["id"]
-                capping_player = players[capping_player_in_game_id]
-                if not (capping_player["is_red"] or allow_blue_caps):
-                    continue
-                record_time = cap_time - first_timer_ts
-                capping_user_name, capping_user_id = capping_player["name"], capping_player["user_id"]
-                capping_player_msgs = [r for r in replay if r[1] == 'chat' and r[2].get('from') == capping_player_in_game_id]
-                capping_player_quote = capping_player_msgs[-1][2]["message"] if capping_player_msgs else None
-                return record_time, capping_user_name, capping_user_id, capping_player_quote
-        return None, None, None, None
-
-    record_time, capping_user_name, capping_user_id, capping_player_quote = get_run_details()
+    def is_finishing_cap(cap_details):
+        if cap_details.get('s-captures') != caps_to_win:
+            return False
+        return players[cap_details["id"]]["is_red"] or allow_blue_caps
 
-    return {
+    index = index_replay(itertools.chain(header, replay), is_finishing_cap)
+
+    if index["cap"] is not None:
+        cap_time, capping_player_in_game_id = index["cap"]
+        capping_player = players[capping_player_in_game_id]
+        record_time = cap_time - index["first_timer_ts"]
+        capping_user_name, capping_user_id = capping_player["name"], capping_player["user_id"]
+        capping_player_quote = index["last_chat"].get(capping_player_in_game_id)
+    else:
+        record_time, capping_user_name, capping_user_id, capping_player_quote = None, None, None, None
+
+    details = {
         "map_id": effective_map_id,
         "actual_map_id": map_id,
         "preset": None,  # TODO
@@ -198,6 +301,7 @@ def get_details(replay):
         "caps_to_win": caps_to_win,
         "capping_player_quote": capping_player_quote
     }
+    return details, index
 
 
 def write_replay_uuid(uuid):
@@ -205,9 +309,12 @@ def write_replay_uuid(uuid):
         f.write("\n" + uuid.strip())
 
 
-def get_replay_data(uuid):
-    time.sleep(5)
-    response = requests.get(
+# packets get_details reads; the rest (mapupdate, replayPlayerMessage, ...) can be skipped undecoded
+DETAILS_PACKET_TYPES = ("recorder-metadata", "connect", "map", "clientInfo", "time", "p", "chat")
+
+
+def get_replay_game_id(uuid):
+    response = http_client.get(
         "https://tagpro.koalabeast.com/replays/data",
         params={"uuid": uuid}
     )
@@ -219,15 +326,45 @@ def get_replay_data(uuid):
         raise RuntimeError
     if len(data["games"]) != 1:
         return None
-    response = requests.get(
+    return data["games"][0]["id"]
+
+
+def open_game_file(uuid):
+    game_id = get_replay_game_id(uuid)
+    if game_id is None:
+        return None
+    return http_client.get(
         "https://tagpro.koalabeast.com/replays/gameFile",
-        params={"gameId": data["games"][0]["id"]}
+        params={"gameId": game_id},
+        stream=True
     )
-    return [json.loads(line) for line in response.text.splitlines()]
+
+
+def get_replay_stream(uuid, packet_types=None):
+    """yield replay packets as they download, decoding only packet_types; None if not exactly one game"""
+    response = open_game_file(uuid)
+    if response is None:
+        return None
+
+    def packets():
+        with response:
+            yield from iter_packets(response.iter_lines(), packet_types)
+
+    return packets()
+
+
+def get_replay_data(uuid):
+    packets = get_replay_stream(uuid)
+    if packets is None:
+        return None
+    return list(packets)
 
 
 if __name__ == "__main__":
-    process_replays()
+    parser = argparse.ArgumentParser(description="Download and process GLTP replays")
+    parser.add_argument("--workers", type=int, default=1, help="Processes used to parse replay backlogs")
+    args = parser.parse_args()
+    process_replays(args.workers)
 
 
 """
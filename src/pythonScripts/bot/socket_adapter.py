@@ -0,0 +1,148 @@
+import argparse
+import json
+import time
+
+import websocket
+
+from leader import GROUPS_URL, GroupAdapter, TagproBot
+from maps import start_catalog_refresher
+
+SOCKET_URL = "wss://tagpro.koalabeast.com/socket.io/?EIO=4&transport=websocket"
+CONNECT_TIMEOUT = 30
+
+
+class SocketAdapter(GroupAdapter):
+    """group connection over a bare socket.io websocket, without a browser"""
+
+    def __init__(self, group_id, socket_url=SOCKET_URL, cookie=None):
+        super().__init__()
+        self.target_group_id = group_id
+        self.socket_url = socket_url
+        self.cookie = cookie  # the tagpro session cookie, "tagpro=..."; the fake server needs none
+        self.ws = None
+        self.game_active = False
+
+    def current_url(self):
+        return GROUPS_URL + self.target_group_id if self.ws is not None else GROUPS_URL
+
+    def open_group_list(self):
+        self.reset_roster()
+        self.close()
+
+    def join_or_create_group(self, room_name):
+        ws = None
+        try:
+            ws = websocket.create_connection(self.socket_url, cookie=self.cookie, timeout=CONNECT_TIMEOUT)
+            open_packet = ws.recv()  # engine.io open: 0{"sid": ..., "pingInterval": ...}
+            if not open_packet.startswith("0"):
+                raise ValueError(f"unexpected open packet {open_packet!r}")
+            namespace = f"/groups/{self.target_group_id}"
+            ws.send(f"40{namespace},")
+            # the namespace is joined once the server acks with 40; 44 means it refused (e.g. a bad cookie)
+            deadline = time.monotonic() + CONNECT_TIMEOUT
+            while True:
+                if time.monotonic() > deadline:
+                    raise ValueError("no answer to the group join")
+                frame = ws.recv()
+                if frame == "2":
+                    ws.send("3")
+                elif isinstance(frame, str) and frame.startswith(f"40{namespace}"):
+                    break
+                elif isinstance(frame, str) and frame.startswith(f"44{namespace}"):
+                    raise ValueError(f"group join refused: {frame}")
+        except (websocket.WebSocketException, OSError, ValueError) as e:
+            self.event_log.error(f"group socket connect failed: {e}")
+            if ws is not None:
+                ws.close()
+            return False
+        self.reset_roster()
+        self.ws = ws
+        return True
+
+    def close(self):
+        if self.ws is not None:
+            try:
+                self.ws.close()
+            except (websocket.WebSocketException, OSError):
+                pass
+            self.ws = None
+        self.game_active = False
+
+    def process_ws_events(self, timeout=0.0):
+        """dispatch frames as they arrive, for up to timeout seconds"""
+        if self.ws is None:
+            time.sleep(timeout)
+            return
+        deadline = time.monotonic() + timeout
+        while self.ws is not None:
+            self.ws.settimeout(max(0.001, deadline - time.monotonic()))
+            try:
+                frame = self.ws.recv()
+            except websocket.WebSocketTimeoutException:
+                return
+            except (websocket.WebSocketException, OSError) as e:
+                self.event_log.info(f"group socket closed: {e}")
+                self.close()
+                return
+            self.frame_received = time.monotonic()
+            self.handle_frame(frame)
+            # return once the socket has been quiet for 20 ms rather than waiting out the whole timeout
+            deadline = min(deadline, time.monotonic() + 0.02)
+
+    def handle_frame(self, frame):
+        if not isinstance(frame, str):  # binary attachments; the group events used here are all text
+            return
+        if frame == "2":  # engine.io ping
+            self.ws.send("3")
+        elif frame.startswith(("41", "44")):  # kicked out of the namespace, or refused
+            self.close()
+        elif frame.startswith("42"):
+            payload = frame[frame.index(",") + 1:] if frame.startswith("42/") else frame[2:]
+            try:
+                msg = json.loads(payload)
+            except ValueError:
+                return
+            self.log_frame("recv", msg)
+            if isinstance(msg, list) and len(msg) >= 2 and msg[0] == "game":
+                self.game_active = isinstance(msg[1], dict) and msg[1].get("gameId") is not None
+            self.dispatch(msg)
+
+    def send_frames(self, frames):
+        if self.ws is None:
+            return False
+        try:
+            for frame in frames:
+                self.ws.send(frame)
+        except (websocket.WebSocketException, OSError) as e:
+            self.event_log.error(f"group socket send failed: {e}")
+            self.close()
+            return False
+        return True
+
+    def scrape_lobby_players(self):
+        # no page to compare against; the frame-built roster is all there is
+        return self.get_lobby_players()
+
+    def is_game_active(self):
+        return self.game_active
+
+    def read_game_uuid(self):
+        return None
+
+    def pug_available(self):
+        return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the group bot over a bare websocket, without Chrome")
+    parser.add_argument("group_id", help="Group to join, the last part of its /groups/ URL")
+    parser.add_argument("--socket-url", default=SOCKET_URL, help="e.g. the fake_group_server.py URL")
+    parser.add_argument("--cookie", help="tagpro session cookie, as 'tagpro=...'")
+    args = parser.parse_args()
+
+    start_catalog_refresher()
+    TagproBot(SocketAdapter(args.group_id, args.socket_url, args.cookie)).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+import bisect
+import functools
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+
+
+class StatsStore:
+    """processed replay stats in SQLite, keyed by uuid"""
+
+    def __init__(self, path, legacy_json_path=None):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS replay_stats (
+                uuid TEXT PRIMARY KEY,
+                map_id TEXT,
+                capping_player_user_id TEXT,
+                record_time INTEGER,
+                timestamp INTEGER,
+                entry TEXT NOT NULL,
+                actual_map_id TEXT,
+                catalog_deps TEXT
+            );
+            CREATE INDEX IF NOT EXISTS replay_stats_map ON replay_stats (map_id, record_time);
+            CREATE INDEX IF NOT EXISTS replay_stats_player ON replay_stats (capping_player_user_id);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+            INSERT OR IGNORE INTO meta VALUES ('generation', 0);
+            INSERT OR IGNORE INTO meta VALUES ('epoch', 0);
+        """)
+        self._add_catalog_columns()
+        self._uuids = {row[0] for row in self.conn.execute("SELECT uuid FROM replay_stats")}
+        if not self._uuids and legacy_json_path and os.path.exists(legacy_json_path):
+            self.import_json(legacy_json_path)
+
+    def _add_catalog_columns(self):
+        """databases from before catalog dependencies were tracked get the columns, filled from the entries"""
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(replay_stats)")}
+        if "actual_map_id" not in columns:
+            with self.conn:
+                self.conn.execute("ALTER TABLE replay_stats ADD COLUMN actual_map_id TEXT")
+                self.conn.execute("ALTER TABLE replay_stats ADD COLUMN catalog_deps TEXT")
+                rows = self.conn.execute("SELECT uuid, entry FROM replay_stats").fetchall()
+                self.conn.executemany(
+                    "UPDATE replay_stats SET actual_map_id = ? WHERE uuid = ?",
+                    [(json.loads(entry).get("actual_map_id"), uuid) for uuid, entry in rows]
+                )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS replay_stats_catalog ON replay_stats (actual_map_id, catalog_deps)")
+
+    def uuids(self):
+        return set(self._uuids)
+
+    def add(self, entries, catalog_deps=None):
+        """insert or replace entries; catalog_deps maps uuid -> catalog_fingerprint"""
+        catalog_deps = catalog_deps or {}
+        rows = [
+            (
+                e["uuid"], e["map_id"], e["capping_player_user_id"], e["record_time"], e["timestamp"], json.dumps(e),
+                e.get("actual_map_id"), catalog_deps.get(e["uuid"])
+            )
+            for e in entries
+        ]
+        replaced = any(row[0] in self._uuids for row in rows)
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO replay_stats "
+                "(uuid, map_id, capping_player_user_id, record_time, timestamp, entry, actual_map_id, catalog_deps) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                rows
+            )
+            self.conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'generation'")
+            if replaced:
+                self.conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'epoch'")
+        self._uuids.update(row[0] for row in rows)
+
+    def generation(self):
+        """bumped by every write, from any process; compare against a saved value to see if anything changed"""
+        with self.lock:
+            return self.conn.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()[0]
+
+    def epoch(self):
+        """bumped by writes that replace existing rows, after which incremental readers must start over"""
+        with self.lock:
+            return self.conn.execute("SELECT value FROM meta WHERE key = 'epoch'").fetchone()[0]
+
+    def catalog_dependencies(self):
+        """distinct (actual_map_id, catalog_deps) pairs; catalog_deps is None for rows parsed before it was recorded"""
+        with self.lock:
+            return self.conn.execute("SELECT DISTINCT actual_map_id, catalog_deps FROM replay_stats").fetchall()
+
+    def uuids_with_catalog_deps(self, actual_map_id, catalog_deps):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT uuid FROM replay_stats WHERE actual_map_id IS ? AND catalog_deps IS ?",
+                (actual_map_id, catalog_deps)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def set_catalog_deps(self, uuids, catalog_deps):
+        """record the catalog fields of rows whose stats are already known to match them"""
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "UPDATE replay_stats SET catalog_deps = ? WHERE uuid = ?", [(catalog_deps, uuid) for uuid in uuids]
+            )
+
+    def finished_runs_since(self, rowid):
+        """(rowid, map_id, record_time, entry) of finished runs added after rowid"""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT rowid, map_id, record_time, entry FROM replay_stats WHERE rowid > ? AND record_time ORDER BY rowid",
+                (rowid,)
+            ).fetchall()
+        return [(rowid, map_id, record_time, json.loads(entry)) for rowid, map_id, record_time, entry in rows]
+
+    def entries(self, where="1", params=()):
+        with self.lock:
+            rows = self.conn.execute(f"SELECT entry FROM replay_stats WHERE {where} ORDER BY rowid", params).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def get_wr_entry(self, map_id):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT entry FROM replay_stats WHERE map_id = ? AND record_time ORDER BY record_time, rowid LIMIT 1",
+                (map_id,)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def import_json(self, path):
+        data = json.load(open(path))
+        self.add(data.values() if isinstance(data, dict) else data)
+
+    def export_json(self, path):
+        """write every entry to path"""
+        with self.lock:
+            rows = self.conn.execute("SELECT entry FROM replay_stats ORDER BY rowid").fetchall()
+        entries = (json.loads(row[0]) for row in rows)
+        write_json_atomic(path, {e["uuid"]: e for e in entries})
+
+
+def write_json_atomic(path, data):
+    write_text_atomic(path, json.dumps(data))
+
+
+def write_text_atomic(path, text):
+    # a temp file of its own, so concurrent writers never replace each other's
+    with tempfile.NamedTemporaryFile(
+        "w", dir=os.path.dirname(path) or ".", suffix=".tmp", delete=False, encoding="utf-8", newline=""
+    ) as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.chmod(f.name, 0o644)  # temp files are private; the exports are served as-is
+    os.replace(f.name, path)
+
+
+class WRIndex:
+    """fastest top_n runs per map, refreshed from the rows added since the last read"""
+
+    def __init__(self, store, top_n=1):
+        self.store = store
+        self.top_n = top_n
+        self.runs = {}  # map_id -> [(record_time, rowid, entry), ...] fastest first
+        self.last_rowid = 0
+        self.generation = None
+        self.epoch = None
+        self.lock = threading.Lock()  # bots hosted in one process share the index
+
+    def refresh(self):
+        with self.lock:
+            self._refresh()
+
+    def _refresh(self):
+        generation = self.store.generation()
+        if generation == self.generation:
+            return
+        self.generation = generation
+        epoch = self.store.epoch()
+        if epoch != self.epoch:  # rows were replaced, so runs already read may be gone
+            self.epoch = epoch
+            self.runs = {}
+            self.last_rowid = 0
+        for rowid, map_id, record_time, entry in self.store.finished_runs_since(self.last_rowid):
+            runs = self.runs.setdefault(map_id, [])
+            bisect.insort(runs, (record_time, rowid, entry), key=lambda run: run[:2])
+            del runs[self.top_n:]
+            self.last_rowid = rowid
+
+    def top(self, map_id):
+        self.refresh()
+        return [entry for _, _, entry in list(self.runs.get(map_id, []))]
+
+    def get(self, map_id):
+        top = self.top(map_id)
+        return top[0] if top else None
+
+
+@functools.lru_cache(maxsize=None)
+def get_stats_store(path="replay_stats.db", legacy_json_path="replay_stats.json"):
+    return StatsStore(path, legacy_json_path)
+
+
+@functools.lru_cache(maxsize=None)
+def get_wr_index():
+    return WRIndex(get_stats_store())
@@ -0,0 +1,5 @@
+# the scripts here import the modules in bot/; importing this first puts that directory on the path
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot"))
@@ -1,24 +1,8 @@
-import io, csv, requests, json, sys
+import json, sys
 from collections import defaultdict
 
-def get_replay_data(uuid):
-    response = requests.get(
-        "https://tagpro.koalabeast.com/replays/data",
-        params={"uuid": uuid}
-    )
-    if response.status_code == 429:
-        raise RuntimeError
-    try:
-        data = response.json()
-    except requests.exceptions.JSONDecodeError:
-        raise RuntimeError
-    if len(data["games"]) != 1:
-        return None
-    response = requests.get(
-        "https://tagpro.koalabeast.com/replays/gameFile",
-        params={"gameId": data["games"][0]["id"]}
-    )
-    return [json.loads(line) for line in response.text.splitlines()]
+import bot_path  # noqa: F401
+from replay_manager import get_replay_data
 
 def format_ms(ms):
     minutes = ms // 60000